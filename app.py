@@ -1,40 +1,171 @@
+import atexit
 from contextlib import contextmanager
 from datetime import date
+import functools
 import os
-import re
+import sqlite3
+import tempfile
+import time
 
-from flask import Flask, g, jsonify, render_template, request
+from flask import Flask, Response, g, jsonify, render_template, request, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+from jinja2 import FileSystemBytecodeCache
+
+try:
+    import orjson
+except ImportError:  # optional: faster JSON encoding when installed
+    orjson = None
 
 import db
 import ecb
 import helpers
 import import_utils
 from config import CONTINUATION_ALERT_DAYS, BASE_CURRENCY
-from export import export_xlsx
+from export import ExportWorker
+
+
+class RowJSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, also serializing sqlite3.Row as an object."""
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, sqlite3.Row):
+            return dict(zip(o.keys(), o))
+        return DefaultJSONProvider.default(o)
+
+
+class OrjsonProvider(RowJSONProvider):
+    """Flask JSON provider backed by orjson, keeping Flask's key sorting."""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app) if orjson is not None else RowJSONProvider(app)
+
+# Compiled templates survive restarts; auto_reload already follows app.debug.
+# Jinja's default cache dir is per-user (mode 0700, ownership checked), so no
+# other account on the host can plant bytecode for us to load.
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
+# Auto-export runs in the background; failures are reported by /api/export-status
+export_worker = ExportWorker()
+
+# Closing the pool runs PRAGMA optimize on the writer before the process exits
+atexit.register(db.close_pool)
+
+
+def _queue_export(export_path=None):
+    """Schedule an .xlsx re-export without blocking the request."""
+    export_worker.submit(export_path)
+
+
+# Bumped after every write so cached pages built from older data are ignored
+_data_version = 0
+
+DASHBOARD_CACHE_TTL = 30  # seconds
+ADVANCES_PAGE_SIZE = 200
+_dashboard_cache = None  # (key, rendered_at, html)
 
 
-def _try_export(export_path=None):
-    """Run export; return warning string on failure, None on success."""
+@contextmanager
+def db_conn(write=False):
+    """Borrow a pooled connection; pass write=True for routes that modify data.
+
+    A write block runs as one transaction: committed when the block exits
+    normally (including early returns), rolled back if it raises.
+    """
+    global _data_version
+    pool = db.get_pool()
+    if not write:
+        with pool.reader() as conn:
+            yield conn
+        return
+    with pool.writer() as conn:
+        try:
+            with db.write_tx(conn):
+                yield conn
+        finally:
+            _data_version += 1
+
+
+_currencies_cache = None  # ((db_path, data_version), rows)
+
+
+def get_currencies_cached():
+    """Currencies in display order; re-read from the database only after a write."""
+    global _currencies_cache
+    key = (db.DB_PATH, _data_version)
+    cached = _currencies_cache
+    if cached is None or cached[0] != key:
+        with db_conn() as conn:
+            cached = _currencies_cache = (key, db.get_currencies(conn))
+    return cached[1]
+
+
+_settings_cache = None  # ((db_path, data_version), {key: value})
+
+
+def get_settings_cached():
+    """All settings as a dict; re-read only after a write.  Do not mutate."""
+    global _settings_cache
+    key = (db.DB_PATH, _data_version)
+    cached = _settings_cache
+    if cached is None or cached[0] != key:
+        with db_conn() as conn:
+            cached = _settings_cache = (key, db.get_all_settings(conn))
+    return cached[1]
+
+
+def _load_fx_cache():
     try:
-        export_xlsx(export_path=export_path)
+        with db_conn() as conn:
+            return db.get_fx_cache(conn)
+    except sqlite3.Error:
+        app.logger.warning("Could not read stored FX rates", exc_info=True)
         return None
-    except Exception:
-        app.logger.exception("Auto-export failed")
-        return "Auto-export failed — see server log for details"
 
 
-@contextmanager
-def db_conn():
-    conn = db.get_db()
+def _save_fx_cache(fetch_date, fetched_at, rates):
+    # Not user data, so _data_version (and the page caches) are left alone
     try:
-        yield conn
-    finally:
-        conn.close()
+        with db.get_pool().writer() as conn, db.write_tx(conn):
+            db.save_fx_cache(conn, fetch_date, fetched_at, rates)
+    except sqlite3.Error:
+        app.logger.warning("Could not store FX rates", exc_info=True)
+
 
+# ECB rates survive restarts, so a fresh process does not wait on the network
+ecb.set_store(_load_fx_cache, _save_fx_cache)
 
-def parse_json(required_fields=None):
+
+def stream_json_rows(fetch):
+    """Stream the rows of ``fetch(conn)`` as a JSON array, one row at a time."""
+    def generate():
+        with db_conn() as conn:
+            yield "["
+            sep = ""
+            for row in fetch(conn):
+                yield sep + app.json.dumps(row)
+                sep = ","
+            yield "]"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+def parse_json(required_fields=None, string_fields=()):
+    """Return (data, None) or (None, error_response).
+
+    Fields listed in string_fields must be non-empty strings and come back
+    stripped, so routes can use them as-is.
+    """
     data = request.get_json(silent=True)
     if not isinstance(data, dict):
         return None, (jsonify({"ok": False, "error": "Invalid JSON payload"}), 400)
@@ -46,6 +177,12 @@ def parse_json(required_fields=None):
                 jsonify({"ok": False, "error": f"Missing required field(s): {', '.join(missing)}"}),
                 400,
             )
+
+    for field in string_fields:
+        value = data.get(field)
+        if not isinstance(value, str) or not value.strip():
+            return None, (jsonify({"ok": False, "error": f"{field} must be a non-empty string"}), 400)
+        data[field] = value.strip()
     return data, None
 
 
@@ -64,12 +201,33 @@ def validate_advance_date_order(data):
 def build_continuation_calendar(alerts, year=None, month=None):
     """Build calendar metadata for a given month with continuation dates marked.
 
-    Defaults to the current month when year/month are None.
+    Defaults to the current month when year/month are None. Cells are laid out
+    as parallel sequences: ``days`` ("" for padding), ``dates`` (None for
+    padding), ``marked_mask`` (one byte per cell) and ``today_idx`` (None when
+    today is not in the month).
     """
     today = date.today()
     year = year or today.year
     month = month or today.month
+    marked_key = frozenset(str(a["continuation_date"]) for a in alerts)
+    days, dates, marked_mask, today_idx = _calendar_cells(
+        today.toordinal(), year, month, marked_key
+    )
 
+    return {
+        "month_label": date(year, month, 1).strftime("%B %Y"),
+        "year": year,
+        "month": month,
+        "days": days,
+        "dates": dates,
+        "marked_mask": marked_mask,
+        "today_idx": today_idx,
+    }
+
+
+@functools.lru_cache(maxsize=8)
+def _calendar_cells(today_ord, year, month, marked_dates):
+    """Grid columns for one month; cached because the inputs rarely change."""
     month_start = date(year, month, 1)
 
     if month == 12:
@@ -79,111 +237,117 @@ def build_continuation_calendar(alerts, year=None, month=None):
 
     days_in_month = (next_month - month_start).days
     leading_blanks = month_start.weekday()  # Monday=0
-    marked_dates = {str(a["continuation_date"]) for a in alerts}
-
-    is_current_month = (year == today.year and month == today.month)
-
-    cells = []
-    for _ in range(leading_blanks):
-        cells.append({"day": "", "date": None, "marked": False, "today": False})
-
-    for day_num in range(1, days_in_month + 1):
-        day_date = date(year, month, day_num)
-        iso = day_date.isoformat()
-        cells.append({
-            "day": day_num,
-            "date": iso,
-            "marked": iso in marked_dates,
-            "today": is_current_month and day_date == today,
-        })
+    month_ord = month_start.toordinal()
 
-    while len(cells) % 7 != 0:
-        cells.append({"day": "", "date": None, "marked": False, "today": False})
+    days = [""] * leading_blanks + list(range(1, days_in_month + 1))
+    dates = [None] * leading_blanks + [
+        date(year, month, d).isoformat() for d in range(1, days_in_month + 1)
+    ]
+    marked_mask = bytearray(len(days))
+    for i in range(leading_blanks, len(days)):
+        if dates[i] in marked_dates:
+            marked_mask[i] = 1
 
-    return {
-        "month_label": month_start.strftime("%B %Y"),
-        "year": year,
-        "month": month,
-        "cells": cells,
-    }
+    today_idx = None
+    if 0 <= today_ord - month_ord < days_in_month:
+        today_idx = leading_blanks + today_ord - month_ord
+
+    padding = -len(days) % 7
+    days += [""] * padding
+    dates += [None] * padding
+    marked_mask += bytes(padding)
+
+    return tuple(days), tuple(dates), bytes(marked_mask), today_idx
 
 
 @app.context_processor
 def inject_globals():
-    """Make currencies list and settings available in every template."""
-    with db_conn() as conn:
-        currencies = [dict(r) for r in db.get_currencies(conn)]
-        g.settings = db.get_all_settings(conn)
+    """Make currencies list and settings available in every template.
+
+    Loaded once per request and kept on ``g``, so further renders reuse it.
+    """
+    if "template_globals" not in g:
+        currencies = get_currencies_cached()
+        g.settings = get_settings_cached()
         fx_rates, ecb_date = ecb.get_fx_rates(currencies)
-        return {
+        g.template_globals = {
             "currencies": currencies,
             "BASE_CURRENCY": BASE_CURRENCY,
             "settings": g.settings,
             "fx_rates": fx_rates,
             "ecb_date": ecb_date,
         }
+    return g.template_globals
 
 
 # ── Dashboard ──
 
 @app.route("/")
 def dashboard():
+    global _dashboard_cache
+    today = date.today()
+    cache_key = (db.DB_PATH, _data_version, today)
+    cached = _dashboard_cache
+    if cached and cached[0] == cache_key and time.monotonic() - cached[1] < DASHBOARD_CACHE_TTL:
+        return _dashboard_response(cached[2])
+
     with db_conn() as conn:
-        totals_rows = db.get_active_totals(conn)
-        totals = {r["currency"]: {"total": r["total"], "count": r["count"]} for r in totals_rows}
+        bundle = db.get_dashboard_bundle(conn, CONTINUATION_ALERT_DAYS, today)
+
+    totals = {r["currency"]: {"total": r["total"], "count": r["count"]} for r in bundle["totals"]}
+
+    alerts = [dict(r) for r in bundle["alerts"]]
+    for a in alerts:
+        cont = date.fromisoformat(a["continuation_date"])
+        a["cont_day"] = cont.day
+        a["cont_mon"] = cont.strftime("%b").upper()
+        a["cont_weekday"] = cont.strftime("%a")
+
+    # Calendar uses all continuations for the current month, not just 7-day alerts
+    cal_advances = bundle["calendar"]
+    continuation_calendar = build_continuation_calendar(cal_advances)
+
+    tooltip_map = {}
+    for a in cal_advances:
+        d = a["continuation_date"]
+        line = f"{a['id']} · {a['bank']} · {a['currency']} {int(a['amount_original']):,}"
+        tooltip_map.setdefault(d, []).append(line)
+    tooltip_map = {d: "\n".join(lines) for d, lines in tooltip_map.items()}
+
+    upcoming = [dict(r) for r in bundle["upcoming"]]
+    for a in upcoming:
+        cont = date.fromisoformat(a["continuation_date"])
+        a["cont_day"] = cont.day
+        a["cont_mon"] = cont.strftime("%b").upper()
+        a["cont_weekday"] = cont.strftime("%a")
+
+    html = render_template(
+        "dashboard.html",
+        totals=totals,
+        alerts=alerts,
+        upcoming=upcoming,
+        active=bundle["active"],
+        utilization=bundle["utilization"],
+        continuation_calendar=continuation_calendar,
+        tooltip_map=tooltip_map,
+        today=today.isoformat(),
+        cont_limit=bundle["upcoming_limit"],
+    )
+    _dashboard_cache = (cache_key, time.monotonic(), html)
+    return _dashboard_response(html)
 
-        alerts = db.get_continuation_alerts(conn, CONTINUATION_ALERT_DAYS)
-        alerts = [helpers.enrich_advance(a) for a in alerts]
-        for a in alerts:
-            cont = date.fromisoformat(a["continuation_date"])
-            a["cont_day"] = cont.day
-            a["cont_mon"] = cont.strftime("%b").upper()
-            a["cont_weekday"] = cont.strftime("%a")
-
-        # Calendar uses all continuations for the current month, not just 7-day alerts
-        today = date.today()
-        cal_rows = db.get_continuations_for_month(conn, today.year, today.month)
-        cal_advances = [helpers.enrich_advance(a) for a in cal_rows]
-        continuation_calendar = build_continuation_calendar(cal_advances)
-
-        tooltip_map = {}
-        for a in cal_advances:
-            d = a["continuation_date"]
-            line = f"{a['id']} · {a['bank']} · {a['currency']} {int(a['amount_original']):,}"
-            tooltip_map.setdefault(d, []).append(line)
-        tooltip_map = {d: "\n".join(lines) for d, lines in tooltip_map.items()}
-
-        limit_setting = db.get_setting(conn, "continuation_limit", "5")
-        upcoming_limit = None if limit_setting == "all" else int(limit_setting)
-        upcoming = db.get_upcoming_continuations(conn, limit=upcoming_limit)
-        upcoming = [helpers.enrich_advance(a) for a in upcoming]
-        for a in upcoming:
-            cont = date.fromisoformat(a["continuation_date"])
-            a["cont_day"] = cont.day
-            a["cont_mon"] = cont.strftime("%b").upper()
-            a["cont_weekday"] = cont.strftime("%a")
-
-        active = db.get_active_advances(conn)
-        active = [helpers.enrich_advance(a) for a in active]
-
-        utilization = [dict(r) for r in db.get_cl_utilization(conn)]
-
-        return render_template(
-            "dashboard.html",
-            totals=totals,
-            alerts=alerts,
-            upcoming=upcoming,
-            active=active,
-            utilization=utilization,
-            continuation_calendar=continuation_calendar,
-            tooltip_map=tooltip_map,
-            today=today.isoformat(),
-            cont_limit=upcoming_limit,
-        )
+
+def _dashboard_response(html):
+    """Dashboard HTML with an ETag; browsers revalidate on every load and get
+    a bodiless 304 while the page is unchanged."""
+    resp = Response(html, mimetype="text/html")
+    resp.add_etag()
+    resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
 
 
 # ── Banks ──
-# No _try_export() here: banks are not exported to xlsx.  Advances and
+# No _queue_export() here: banks are not exported to xlsx.  Advances and
 # credit lines reference banks by key, which never changes via upsert.
 
 @app.route("/banks")
@@ -195,18 +359,21 @@ def banks_page():
 
 @app.route("/banks", methods=["POST"])
 def create_bank():
-    data, err = parse_json(required_fields=["bank_key", "bank_name"])
+    data, err = parse_json(
+        required_fields=["bank_key", "bank_name"],
+        string_fields=("bank_key", "bank_name"),
+    )
     if err:
         return err
 
-    with db_conn() as conn:
-        db.upsert_bank(conn, data["bank_key"].strip(), data["bank_name"].strip())
+    with db_conn(write=True) as conn:
+        db.upsert_bank(conn, data["bank_key"], data["bank_name"])
         return jsonify({"ok": True})
 
 
 @app.route("/banks/<key>", methods=["DELETE"])
 def delete_bank(key):
-    with db_conn() as conn:
+    with db_conn(write=True) as conn:
         db.delete_bank(conn, key)
         return jsonify({"ok": True})
 
@@ -216,9 +383,8 @@ def delete_bank(key):
 @app.route("/credit-lines")
 def credit_lines_page():
     with db_conn() as conn:
-        lines = db.get_all_credit_lines(conn)
-        banks = db.get_banks(conn)
-        return render_template("credit_lines.html", lines=lines, banks=banks)
+        data = db.get_credit_lines_page_data(conn)
+    return render_template("credit_lines.html", **data)
 
 
 @app.route("/credit-lines", methods=["POST"])
@@ -229,13 +395,10 @@ def create_credit_line():
     if err:
         return err
 
-    with db_conn() as conn:
+    with db_conn(write=True) as conn:
         cl_id = db.create_credit_line(conn, data)
-        warn = _try_export()
-        resp = {"ok": True, "id": cl_id}
-        if warn:
-            resp["export_warning"] = warn
-        return jsonify(resp)
+    _queue_export()
+    return jsonify({"ok": True, "id": cl_id})
 
 
 @app.route("/credit-lines/<cl_id>", methods=["GET"])
@@ -244,7 +407,7 @@ def get_credit_line(cl_id):
         row = db.get_credit_line(conn, cl_id)
         if not row:
             return jsonify({"error": "Not found"}), 404
-        return jsonify(dict(row))
+        return jsonify(row)
 
 
 @app.route("/credit-lines/<cl_id>", methods=["PUT"])
@@ -255,47 +418,48 @@ def update_credit_line(cl_id):
     if err:
         return err
 
-    with db_conn() as conn:
+    with db_conn(write=True) as conn:
         db.update_credit_line(conn, cl_id, data)
-        warn = _try_export()
-        resp = {"ok": True}
-        if warn:
-            resp["export_warning"] = warn
-        return jsonify(resp)
+    _queue_export()
+    return jsonify({"ok": True})
 
 
 @app.route("/credit-lines/<cl_id>", methods=["DELETE"])
 def archive_credit_line(cl_id):
-    with db_conn() as conn:
+    with db_conn(write=True) as conn:
         db.archive_credit_line(conn, cl_id)
-        warn = _try_export()
-        resp = {"ok": True}
-        if warn:
-            resp["export_warning"] = warn
-        return jsonify(resp)
+    _queue_export()
+    return jsonify({"ok": True})
 
 
 @app.route("/credit-lines/<cl_id>/restore", methods=["PATCH"])
 def restore_credit_line(cl_id):
-    with db_conn() as conn:
+    with db_conn(write=True) as conn:
         db.restore_credit_line(conn, cl_id)
-        warn = _try_export()
-        resp = {"ok": True}
-        if warn:
-            resp["export_warning"] = warn
-        return jsonify(resp)
+    _queue_export()
+    return jsonify({"ok": True})
 
 
 # ── Fixed Advances ──
 
 @app.route("/advances")
 def advances_page():
+    before_date = request.args.get("before_date")
+    before_id = request.args.get("before_id")
+    before = (before_date, before_id) if before_date and before_id else None
     with db_conn() as conn:
-        advances = db.get_advances(conn)
-        advances = [helpers.enrich_advance(a) for a in advances]
-        banks = db.get_banks(conn)
-        lines = db.get_credit_lines(conn)
-        return render_template("advances.html", advances=advances, banks=banks, lines=lines)
+        # Fetch one extra row to learn whether an older page exists
+        data = db.get_advances_page_data(conn, limit=ADVANCES_PAGE_SIZE + 1, before=before)
+    rows = data["advances"]
+    advances = rows[:ADVANCES_PAGE_SIZE]
+    next_page = None
+    if len(rows) > ADVANCES_PAGE_SIZE:
+        last = advances[-1]
+        next_page = {"before_date": last["start_date"], "before_id": last["id"]}
+    return render_template(
+        "advances.html", advances=advances, total=data["total"], paged=before is not None,
+        next_page=next_page, banks=data["banks"], lines=data["lines"],
+    )
 
 
 @app.route("/advances", methods=["POST"])
@@ -318,13 +482,10 @@ def create_advance():
     if date_err:
         return date_err
 
-    with db_conn() as conn:
+    with db_conn(write=True) as conn:
         fv_id = db.create_advance(conn, data)
-        warn = _try_export()
-        resp = {"ok": True, "id": fv_id}
-        if warn:
-            resp["export_warning"] = warn
-        return jsonify(resp)
+    _queue_export()
+    return jsonify({"ok": True, "id": fv_id})
 
 
 @app.route("/advances/<fv_id>", methods=["GET"])
@@ -356,24 +517,18 @@ def update_advance(fv_id):
     if date_err:
         return date_err
 
-    with db_conn() as conn:
+    with db_conn(write=True) as conn:
         db.update_advance(conn, fv_id, data)
-        warn = _try_export()
-        resp = {"ok": True}
-        if warn:
-            resp["export_warning"] = warn
-        return jsonify(resp)
+    _queue_export()
+    return jsonify({"ok": True})
 
 
 @app.route("/advances/<fv_id>", methods=["DELETE"])
 def delete_advance(fv_id):
-    with db_conn() as conn:
+    with db_conn(write=True) as conn:
         db.delete_advance(conn, fv_id)
-        warn = _try_export()
-        resp = {"ok": True}
-        if warn:
-            resp["export_warning"] = warn
-        return jsonify(resp)
+    _queue_export()
+    return jsonify({"ok": True})
 
 
 # ── API Endpoints ──
@@ -416,10 +571,13 @@ def check_cl_capacity():
 
 @app.route("/api/ecb-rate")
 def ecb_rate():
-    with db_conn() as conn:
-        currencies = [dict(r) for r in db.get_currencies(conn)]
-        rates, rate_date = ecb.get_fx_rates(currencies)
-        return jsonify({"rates": rates, "date": rate_date})
+    rates, rate_date = ecb.get_fx_rates(get_currencies_cached())
+    resp = jsonify({"rates": rates, "date": rate_date})
+    resp.add_etag()
+    resp.cache_control.public = True
+    # A missing date means the fetch failed; let clients retry sooner
+    resp.cache_control.max_age = ecb.FX_CACHE_TTL if rate_date else ecb.FX_RETRY_AFTER
+    return resp.make_conditional(request)
 
 
 @app.route("/api/continuation-calendar")
@@ -435,7 +593,7 @@ def api_continuation_calendar():
 
     with db_conn() as conn:
         rows = db.get_continuations_for_month(conn, year, month)
-        alerts = [helpers.enrich_advance(a) for a in rows]
+        alerts = [dict(r) for r in rows]
         for a in alerts:
             cont = date.fromisoformat(a["continuation_date"])
             a["cont_day"] = cont.day
@@ -452,6 +610,7 @@ def api_continuation_calendar():
             for a in alerts
         ]
 
+        calendar["marked_mask"] = list(calendar["marked_mask"])
         return jsonify({"calendar": calendar, "items": items})
 
 
@@ -459,40 +618,41 @@ def api_continuation_calendar():
 
 @app.route("/api/currencies")
 def list_currencies():
-    with db_conn() as conn:
-        rows = db.get_currencies(conn)
-        return jsonify([dict(r) for r in rows])
+    return stream_json_rows(db.iter_currencies)
 
 
 @app.route("/api/currencies", methods=["POST"])
 def add_currency():
-    data, err = parse_json(required_fields=["code"])
+    data, err = parse_json(required_fields=["code"], string_fields=("code",))
     if err:
         return err
-    code = (data.get("code") or "").strip().upper()
-    if not re.match(r"^[A-Z]{3}$", code):
+    code = data["code"].upper()
+    if not (len(code) == 3 and code.isascii() and code.isalpha()):
         return jsonify({"ok": False, "error": "Currency code must be exactly 3 letters"}), 400
 
     with db_conn() as conn:
-        # Check if already exists
         existing = conn.execute("SELECT code FROM currencies WHERE code = ?", (code,)).fetchone()
-        if existing:
-            return jsonify({"ok": False, "error": f"{code} already exists"}), 409
+    if existing:
+        return jsonify({"ok": False, "error": f"{code} already exists"}), 409
 
-        # Validate against ECB
-        ecb_ok, ecb_msg = ecb.validate_currency_ecb(code)
+    # Validate against ECB before taking the write lock; this is a network call
+    ecb_ok, ecb_msg = ecb.validate_currency_ecb(code)
 
-        db.add_currency(conn, code, ecb_available=ecb_ok)
+    try:
+        with db_conn(write=True) as conn:
+            db.add_currency(conn, code, ecb_available=ecb_ok)
+    except sqlite3.IntegrityError:
+        return jsonify({"ok": False, "error": f"{code} already exists"}), 409
 
-        # Clear ECB cache so new currency is included in next fetch
-        ecb.clear_cache()
+    # Clear ECB cache so new currency is included in next fetch
+    ecb.clear_cache()
 
-        return jsonify({
-            "ok": True,
-            "code": code,
-            "ecb_available": ecb_ok,
-            "ecb_warning": ecb_msg,
-        })
+    return jsonify({
+        "ok": True,
+        "code": code,
+        "ecb_available": ecb_ok,
+        "ecb_warning": ecb_msg,
+    })
 
 
 @app.route("/api/currencies/<code>", methods=["DELETE"])
@@ -501,7 +661,7 @@ def remove_currency(code):
     if code == BASE_CURRENCY:
         return jsonify({"ok": False, "error": f"Cannot delete base currency ({BASE_CURRENCY})"}), 400
 
-    with db_conn() as conn:
+    with db_conn(write=True) as conn:
         if db.currency_in_use(conn, code):
             return jsonify({"ok": False, "error": f"{code} is in use by advances or credit lines"}), 409
 
@@ -518,53 +678,72 @@ VALID_CONTINUATION_LIMITS = {"3", "5", "10", "all"}
 
 @app.route("/api/settings")
 def list_settings():
-    with db_conn() as conn:
-        return jsonify(db.get_all_settings(conn))
+    return jsonify(get_settings_cached())
 
 
-@app.route("/api/settings", methods=["PUT"])
-def update_setting():
-    data, err = parse_json(required_fields=["key", "value"])
-    if err:
-        return err
+# Re-saving the same export directory skips the filesystem checks; if it
+# disappears later the background export reports the failure instead.
+_last_good_export_path = None
 
-    key = data["key"]
-    value = data["value"]
 
-    if not isinstance(value, str) or not value.strip():
-        return jsonify({"ok": False, "error": "Value must be a non-empty string"}), 400
+def validate_setting(key, value):
+    """Check a settings update. Returns (value to store, None) or (None, error message).
 
+    Has no side effects; update_setting records a good export path only once
+    it has been stored.
+    """
     if key == "display_unit":
         if value not in VALID_DISPLAY_UNITS:
-            return jsonify({"ok": False, "error": f"display_unit must be one of: {', '.join(sorted(VALID_DISPLAY_UNITS))}"}), 400
+            return None, f"display_unit must be one of: {', '.join(sorted(VALID_DISPLAY_UNITS))}"
+        return value, None
 
-    elif key == "continuation_limit":
+    if key == "continuation_limit":
         if value not in VALID_CONTINUATION_LIMITS:
-            return jsonify({"ok": False, "error": f"continuation_limit must be one of: {', '.join(sorted(VALID_CONTINUATION_LIMITS))}"}), 400
+            return None, f"continuation_limit must be one of: {', '.join(sorted(VALID_CONTINUATION_LIMITS))}"
+        return value, None
 
-    elif key == "export_path":
+    if key == "export_path":
         path = os.path.expanduser(value)
         if not os.path.isabs(path):
-            return jsonify({"ok": False, "error": "Export path must be an absolute path"}), 400
-        if not os.path.isdir(path):
-            return jsonify({"ok": False, "error": "Directory does not exist"}), 400
-        if not os.access(path, os.W_OK):
-            return jsonify({"ok": False, "error": "Directory is not writable"}), 400
-        value = path
+            return None, "Export path must be an absolute path"
+        if path != _last_good_export_path:
+            if not os.path.isdir(path):
+                return None, "Directory does not exist"
+            if not os.access(path, os.W_OK):
+                return None, "Directory is not writable"
+        return path, None
 
-    else:
-        return jsonify({"ok": False, "error": f"Unknown setting: {key}"}), 400
+    return None, f"Unknown setting: {key}"
 
-    with db_conn() as conn:
+
+@app.route("/api/settings", methods=["PUT"])
+def update_setting():
+    global _last_good_export_path
+    data, err = parse_json(required_fields=["key", "value"], string_fields=("value",))
+    if err:
+        return err
+
+    key = data["key"]
+    value, error = validate_setting(key, data["value"])
+    if error:
+        return jsonify({"ok": False, "error": error}), 400
+
+    with db_conn(write=True) as conn:
         db.set_setting(conn, key, value)
 
     # Trigger re-export with the new path so the file lands there immediately
     if key == "export_path":
-        _try_export(export_path=value)
+        _last_good_export_path = value
+        _queue_export(export_path=value)
 
     return jsonify({"ok": True})
 
 
+@app.route("/api/export-status")
+def export_status():
+    return jsonify(export_worker.status())
+
+
 @app.route("/api/browse-dirs")
 def browse_dirs():
     """List subdirectories at a given path for the folder browser UI.
@@ -617,7 +796,6 @@ def import_preview():
     if not f.filename:
         return jsonify({"ok": False, "error": "No file selected"}), 400
 
-    import tempfile
     tmp = tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False)
     try:
         f.save(tmp.name)
@@ -663,7 +841,6 @@ def import_execute():
     f = request.files["file"]
     mode = request.form.get("mode", "append")
 
-    import tempfile
     tmp = tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False)
     try:
         f.save(tmp.name)
@@ -674,20 +851,18 @@ def import_execute():
     finally:
         os.unlink(tmp.name)
 
-    with db_conn() as conn:
-        try:
+    try:
+        with db_conn(write=True) as conn:
             if mode == "overwrite":
                 db.clear_all_data(conn)
 
             banks_result = db.bulk_insert_banks(conn, result["banks"]["rows"])
             cl_result = db.bulk_insert_credit_lines(conn, result["credit_lines"]["rows"])
             adv_result = db.bulk_insert_advances(conn, result["advances"]["rows"])
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            return jsonify({"ok": False, "error": f"Import failed: {e}"}), 500
+    except Exception as e:
+        return jsonify({"ok": False, "error": f"Import failed: {e}"}), 500
 
-    _try_export()
+    _queue_export()
 
     return jsonify({
         "ok": True,
@@ -701,6 +876,8 @@ def import_execute():
 
 @app.template_filter("amount")
 def amount_filter(value):
+    if type(value) is int:  # INTEGER columns arrive as int; skip the conversion
+        return f"{value:,}"
     try:
         return f"{int(value):,}"
     except (ValueError, TypeError):
@@ -711,18 +888,16 @@ def amount_filter(value):
 def amount_short_filter(value):
     try:
         v = int(value)
-        unit = getattr(g, 'settings', {}).get("display_unit", "millions")
-        if unit == "full":
-            return f"{v:,}"
-        if unit == "thousands":
-            return helpers.format_amount_thousands(v)
-        return helpers.format_amount_short(v)
     except (ValueError, TypeError):
         return value
+    unit = getattr(g, 'settings', {}).get("display_unit", "millions")
+    return helpers.format_amount_for_unit(v, unit)
 
 
 @app.template_filter("rate")
 def rate_filter(value):
+    if type(value) is float:
+        return f"{value:.4f}%"
     try:
         return f"{float(value):.4f}%"
     except (ValueError, TypeError):
@@ -733,6 +908,13 @@ def rate_filter(value):
 def date_display_filter(value):
     if not value:
         return ""
+    if isinstance(value, date):
+        return value.strftime("%b %d, %Y")
+    return _format_display_date(value)
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_display_date(value):
     try:
         d = date.fromisoformat(value)
         return d.strftime("%b %d, %Y")
@@ -740,6 +922,32 @@ def date_display_filter(value):
         return value
 
 
-if __name__ == "__main__":
+def warm_templates():
+    """Compile every template up front so the first request doesn't pay for it."""
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+
+def warm_fx_rates():
+    """Fetch ECB rates in the background so the first page render doesn't wait."""
+    ecb.prefetch(get_currencies_cached())
+
+
+def startup():
+    """Prepare the database and warm caches; every entry point calls this once."""
     db.init_db()
-    app.run(debug=True, port=5001)
+    warm_templates()
+    warm_fx_rates()
+
+
+if __name__ == "__main__":
+    startup()
+    if os.environ.get("FLASK_DEBUG") == "1":
+        app.run(debug=True, port=5001)
+    else:
+        try:
+            from waitress import serve
+        except ImportError:  # optional: production WSGI server when installed
+            app.run(port=5001, threaded=True)
+        else:
+            serve(app, host="127.0.0.1", port=5001, threads=8)
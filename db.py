@@ -1,5 +1,15 @@
+import json
+import queue
 import sqlite3
-from config import DB_PATH, BASE_CURRENCY, EXPORT_PATH
+import threading
+from contextlib import contextmanager
+from datetime import date
+
+from config import DB_PATH, BASE_CURRENCY, EXPORT_PATH, INTEREST_YEAR_BASIS
+
+# Stored in PRAGMA user_version once init_db has fully set up a database.
+# Bump it whenever SCHEMA, INDEXES, seeds or migrations change.
+SCHEMA_VERSION = 4
 
 SCHEMA = """
 CREATE TABLE IF NOT EXISTS banks (
@@ -44,6 +54,29 @@ CREATE TABLE IF NOT EXISTS settings (
     key TEXT PRIMARY KEY,
     value TEXT NOT NULL
 );
+
+CREATE TABLE IF NOT EXISTS id_sequences (
+    name TEXT PRIMARY KEY,
+    last_value INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS fx_cache (
+    date TEXT PRIMARY KEY,
+    fetched_at REAL NOT NULL,
+    rates_json TEXT NOT NULL
+);
+"""
+
+# Applied after migrations, since table rebuilds drop existing indexes
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_fa_credit_line ON fixed_advances(credit_line_id, end_date);
+CREATE INDEX IF NOT EXISTS idx_fa_active ON fixed_advances(end_date, start_date);
+CREATE INDEX IF NOT EXISTS idx_fa_continuation ON fixed_advances(continuation_date);
+CREATE INDEX IF NOT EXISTS idx_fa_start ON fixed_advances(start_date, id);
+CREATE INDEX IF NOT EXISTS idx_cl_bank ON credit_lines(bank_key);
+CREATE INDEX IF NOT EXISTS idx_cl_archived ON credit_lines(archived, id);
+CREATE INDEX IF NOT EXISTS idx_fa_currency ON fixed_advances(currency);
+CREATE INDEX IF NOT EXISTS idx_cl_currency ON credit_lines(currency);
 """
 
 # 12-color palette for auto-assigning to new currencies
@@ -72,13 +105,174 @@ DEFAULT_CURRENCIES = [
 ]
 
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
+# Per-connection settings.  journal_mode=WAL is persistent in the database
+# file, so it is set once by init_db() and again when the pool is created.
+CONNECTION_PRAGMAS = (
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -20000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 134217728",
+)
+
+
+# Prepared statements are cached per connection, keyed on the SQL text; the
+# default of 128 leaves little headroom over the ~80 distinct statements here.
+STATEMENT_CACHE_SIZE = 256
+
+
+def _connect(path, check_same_thread=True):
+    conn = sqlite3.connect(
+        path, check_same_thread=check_same_thread, cached_statements=STATEMENT_CACHE_SIZE
+    )
     conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON")
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
 
+def get_db():
+    return _connect(DB_PATH)
+
+
+def close_db(conn):
+    """Close a read-write connection, first letting SQLite refresh any
+    planner statistics its queries showed to be stale."""
+    try:
+        conn.execute("PRAGMA optimize")
+    except sqlite3.OperationalError:
+        pass  # statistics are advisory; never fail a close over them
+    conn.close()
+
+
+@contextmanager
+def write_tx(conn):
+    """Run the block as one BEGIN IMMEDIATE transaction, rolling back on error.
+
+    Write helpers in this module never commit on their own; callers group
+    them inside write_tx so a logical change is one transaction.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+@contextmanager
+def read_tx(conn):
+    """Run several SELECTs against one consistent snapshot of the database."""
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    finally:
+        conn.execute("COMMIT")
+
+
+# ── Connection Pool ──
+
+READ_POOL_SIZE = 4
+
+
+class ConnectionPool:
+    """Long-lived connections to one database: a single writer plus idle readers.
+
+    Reusing connections keeps SQLite's page cache warm between requests and
+    avoids reopening the database file every time.  SQLite allows only one
+    writer, so the write connection is serialized with a lock.  ``readers``
+    read-only connections are opened up front; extra ones are created when
+    all are busy and closed again on return.
+    """
+
+    def __init__(self, path, readers=READ_POOL_SIZE):
+        self.path = path
+        self._closed = False
+        self._write_lock = threading.Lock()
+        self._writer = _connect(path, check_same_thread=False)
+        self._writer.execute("PRAGMA journal_mode = WAL")
+        # Take the write lock when a transaction starts instead of upgrading
+        # from a read lock mid-transaction, which can fail with SQLITE_BUSY.
+        # write_tx issues its own BEGIN IMMEDIATE; the implicit BEGIN is kept
+        # (rather than isolation_level=None) so a stray write outside write_tx
+        # stays uncommitted and writer() rolls it back instead of autocommitting.
+        self._writer.isolation_level = "IMMEDIATE"
+        self._readers = queue.LifoQueue(maxsize=readers)
+        for _ in range(readers):
+            self._readers.put_nowait(self._new_reader())
+
+    def _new_reader(self):
+        conn = _connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    @contextmanager
+    def reader(self):
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            conn = self._new_reader()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            if self._closed:
+                conn.close()
+            else:
+                try:
+                    self._readers.put_nowait(conn)
+                except queue.Full:
+                    conn.close()
+
+    @contextmanager
+    def writer(self):
+        with self._write_lock:
+            try:
+                yield self._writer
+            finally:
+                # Never leak a half-finished transaction into the next request
+                if self._writer.in_transaction:
+                    self._writer.rollback()
+
+    def close(self):
+        self._closed = True
+        with self._write_lock:
+            # Readers are query_only, so only the writer can run PRAGMA optimize
+            close_db(self._writer)
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide pool for DB_PATH, (re)creating it when the path changes."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.path != DB_PATH:
+            if _pool is not None:
+                _pool.close()
+            _pool = ConnectionPool(DB_PATH)
+        return _pool
+
+
+def close_pool():
+    """Close all pooled connections (used at shutdown and by tests)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
 DEFAULT_SETTINGS = {
     "display_unit": "millions",
     "export_path": EXPORT_PATH,
@@ -88,34 +282,56 @@ DEFAULT_SETTINGS = {
 
 def init_db():
     conn = get_db()
-    conn.executescript(SCHEMA)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version == SCHEMA_VERSION:
+        # 0x10002: check every table, since this connection has run no queries yet
+        conn.execute("PRAGMA optimize = 0x10002")
+        conn.close()
+        return
+    # Only takes effect on a new, empty file; must precede the switch to WAL
+    conn.execute("PRAGMA page_size = 8192")
+    conn.execute("PRAGMA journal_mode = WAL")
+    # Tables, seeds and migrations share one transaction (the currency CHECK
+    # migration commits early if it has to run); indexes, statistics and the
+    # version stamp go in a second script, so setup costs two commits.  Both
+    # take the write lock up front so concurrent starts queue on busy_timeout.
+    conn.executescript("BEGIN IMMEDIATE;\n" + SCHEMA)
     _seed_currencies(conn)
     _seed_settings(conn)
-    _migrate_add_czk_pln(conn)
-    _migrate_remove_currency_check(conn)
-    _migrate_add_archived_column(conn)
+    if version < 1:
+        # Pre-versioning migrations; any stamped database already has them
+        _migrate_add_czk_pln(conn)
+        _migrate_remove_currency_check(conn)
+        _migrate_add_archived_column(conn)
+    _migrate_init_sequences(conn)
     conn.commit()
-    conn.close()
+    conn.executescript(
+        "BEGIN IMMEDIATE;\n" + INDEXES + f"ANALYZE;\nPRAGMA user_version = {SCHEMA_VERSION};\nCOMMIT;"
+    )
+    close_db(conn)
 
 
 def _seed_settings(conn):
     """Insert any missing default settings without overwriting existing ones."""
-    for key, value in DEFAULT_SETTINGS.items():
-        conn.execute(
-            "INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)",
-            (key, value),
-        )
+    conn.executemany(
+        "INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)",
+        DEFAULT_SETTINGS.items(),
+    )
 
 
 def _migrate_add_czk_pln(conn):
     """Add CZK and PLN if not already present."""
-    existing = {r[0] for r in conn.execute("SELECT code FROM currencies").fetchall()}
-    new_currencies = [c for c in DEFAULT_CURRENCIES if c[0] in ("CZK", "PLN") and c[0] not in existing]
-    if new_currencies:
-        conn.executemany(
-            "INSERT INTO currencies (code, css_color, display_order, ecb_available) VALUES (?, ?, ?, ?)",
-            new_currencies,
-        )
+    conn.executemany(
+        "INSERT OR IGNORE INTO currencies (code, css_color, display_order, ecb_available) "
+        "VALUES (?, ?, ?, ?)",
+        [c for c in DEFAULT_CURRENCIES if c[0] in ("CZK", "PLN")],
+    )
+
+
+def _migrate_init_sequences(conn):
+    """Start each ID sequence after the highest ID already in its table."""
+    for name in SEQUENCE_CONFIG:
+        _ensure_sequence_row(conn, name)
 
 
 def _seed_currencies(conn):
@@ -189,9 +405,12 @@ def _migrate_add_archived_column(conn):
 # ── Currencies ──
 
 def get_currencies(conn):
-    return conn.execute(
-        "SELECT * FROM currencies ORDER BY display_order"
-    ).fetchall()
+    return iter_currencies(conn).fetchall()
+
+
+def iter_currencies(conn):
+    """Cursor over currencies in display order, for streaming responses."""
+    return conn.execute("SELECT * FROM currencies ORDER BY display_order")
 
 
 def add_currency(conn, code, ecb_available=True):
@@ -201,33 +420,37 @@ def add_currency(conn, code, ecb_available=True):
         "INSERT INTO currencies (code, css_color, display_order, ecb_available) VALUES (?, ?, ?, ?)",
         (code.upper(), color, order, 1 if ecb_available else 0),
     )
-    conn.commit()
 
 
 def delete_currency(conn, code):
     conn.execute("DELETE FROM currencies WHERE code = ?", (code,))
-    conn.commit()
 
 
 def currency_in_use(conn, code):
     """Check if a currency is used by any advance or credit line."""
     row = conn.execute(
-        "SELECT COUNT(*) FROM fixed_advances WHERE currency = ? "
-        "UNION ALL "
-        "SELECT COUNT(*) FROM credit_lines WHERE currency = ?",
-        (code, code),
-    ).fetchall()
-    return any(r[0] > 0 for r in row)
+        "SELECT EXISTS(SELECT 1 FROM fixed_advances WHERE currency = :code) "
+        "OR EXISTS(SELECT 1 FROM credit_lines WHERE currency = :code)",
+        {"code": code},
+    ).fetchone()
+    return bool(row[0])
+
+
+# First palette color (in palette order) not yet taken by a currency
+SQL_NEXT_FREE_COLOR = (
+    "WITH palette(pos, color) AS (VALUES "
+    + ", ".join(f"({i}, '{c}')" for i, c in enumerate(COLOR_PALETTE))
+    + ") SELECT color FROM palette "
+    "WHERE color NOT IN (SELECT css_color FROM currencies WHERE css_color IS NOT NULL) "
+    "ORDER BY pos LIMIT 1"
+)
 
 
 def assign_currency_color(conn):
     """Pick the next unused color from the palette."""
-    used = {r["css_color"] for r in conn.execute("SELECT css_color FROM currencies").fetchall()}
-    for color in COLOR_PALETTE:
-        if color not in used:
-            return color
+    row = conn.execute(SQL_NEXT_FREE_COLOR).fetchone()
     # All 12 used — cycle back to first
-    return COLOR_PALETTE[0]
+    return row[0] if row else COLOR_PALETTE[0]
 
 
 # ── Banks ──
@@ -246,24 +469,82 @@ def upsert_bank(conn, bank_key, bank_name):
         "ON CONFLICT(bank_key) DO UPDATE SET bank_name = excluded.bank_name",
         (bank_key, bank_name),
     )
-    conn.commit()
 
 
 def delete_bank(conn, bank_key):
     conn.execute("DELETE FROM banks WHERE bank_key = ?", (bank_key,))
-    conn.commit()
 
 
 # ── Credit Lines ──
 
+# ── ID Sequences ──
+# New IDs come from a counter row per table instead of scanning for the
+# current maximum, so two concurrent creates can never pick the same ID.
+
+SEQUENCE_CONFIG = {
+    "credit_lines": {"table": "credit_lines", "prefix": "CL", "width": 3},
+    "fixed_advances": {"table": "fixed_advances", "prefix": "FV", "width": 4},
+}
+
+
+# Highest numeric suffix among IDs like PREFIX123 (0 if none), as a SELECT
+# tail; binds :prefix and :start (the suffix offset, len(prefix) + 1).
+_MAX_ID_NUMBER_FROM = (
+    "COALESCE(MAX(CAST(SUBSTR(id, :start) AS INTEGER)), 0) FROM {table} "
+    "WHERE id GLOB :prefix || '[0-9]*' AND SUBSTR(id, :start) NOT GLOB '*[^0-9]*'"
+)
+
+
+def _max_existing_id_number(conn, table_name, prefix):
+    """Highest numeric suffix among IDs like PREFIX123 in table_name (0 if none)."""
+    return conn.execute(
+        "SELECT " + _MAX_ID_NUMBER_FROM.format(table=table_name),
+        {"prefix": prefix, "start": len(prefix) + 1},
+    ).fetchone()[0]
+
+
+def _ensure_sequence_row(conn, name):
+    """Create the sequence row if missing and never let it lag existing IDs."""
+    cfg = SEQUENCE_CONFIG[name]
+    conn.execute(
+        "INSERT INTO id_sequences (name, last_value) "
+        "SELECT :name, " + _MAX_ID_NUMBER_FROM.format(table=cfg["table"]) + " "
+        "ON CONFLICT(name) DO UPDATE SET last_value = MAX(last_value, excluded.last_value)",
+        {"name": name, "prefix": cfg["prefix"], "start": len(cfg["prefix"]) + 1},
+    )
+
+
+# UPDATE ... RETURNING needs SQLite 3.35+; older libraries read the value back
+_SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+_BUMP_SEQUENCE_SQL = "UPDATE id_sequences SET last_value = last_value + 1 WHERE name = ?"
+
+
+def _bump_sequence(conn, name):
+    """Increment the sequence; returns a (last_value,) row, or None if the row is missing."""
+    if _SQLITE_HAS_RETURNING:
+        return conn.execute(_BUMP_SEQUENCE_SQL + " RETURNING last_value", (name,)).fetchone()
+    # Two statements, kept atomic by the caller's BEGIN IMMEDIATE transaction
+    if conn.execute(_BUMP_SEQUENCE_SQL, (name,)).rowcount == 0:
+        return None
+    return conn.execute("SELECT last_value FROM id_sequences WHERE name = ?", (name,)).fetchone()
+
+
+def _next_sequence_value(conn, name):
+    """Atomically bump and return the sequence; runs inside the caller's transaction."""
+    row = _bump_sequence(conn, name)
+    if row is None:
+        _ensure_sequence_row(conn, name)
+        row = _bump_sequence(conn, name)
+    return row[0]
+
+
+def _next_id(conn, name):
+    cfg = SEQUENCE_CONFIG[name]
+    return f"{cfg['prefix']}{_next_sequence_value(conn, name):0{cfg['width']}d}"
+
+
 def next_cl_id(conn):
-    row = conn.execute(
-        "SELECT id FROM credit_lines ORDER BY id DESC LIMIT 1"
-    ).fetchone()
-    if not row:
-        return "CL001"
-    num = int(row["id"][2:]) + 1
-    return f"CL{num:03d}"
+    return _next_id(conn, "credit_lines")
 
 
 def get_credit_lines(conn):
@@ -302,7 +583,6 @@ def create_credit_line(conn, data):
          data["amount"], data["committed"], data["start_date"],
          data.get("end_date") or None, data.get("note")),
     )
-    conn.commit()
     return cl_id
 
 
@@ -314,40 +594,69 @@ def update_credit_line(conn, cl_id, data):
          data["amount"], data["committed"], data["start_date"],
          data.get("end_date") or None, data.get("note"), cl_id),
     )
-    conn.commit()
 
 
 def archive_credit_line(conn, cl_id):
     conn.execute("UPDATE credit_lines SET archived = 1 WHERE id = ?", (cl_id,))
-    conn.commit()
 
 
 def restore_credit_line(conn, cl_id):
     conn.execute("UPDATE credit_lines SET archived = 0 WHERE id = ?", (cl_id,))
-    conn.commit()
 
 
 # ── Fixed Advances ──
 
 def next_fv_id(conn):
-    row = conn.execute(
-        "SELECT id FROM fixed_advances ORDER BY id DESC LIMIT 1"
-    ).fetchone()
-    if not row:
-        return "FV0001"
-    num = int(row["id"][2:]) + 1
-    return f"FV{num:04d}"
-
-
-def get_advances(conn):
+    return _next_id(conn, "fixed_advances")
+
+
+# Advance columns plus the fields helpers.enrich_advance() derives (days,
+# rate_pa, active), computed by SQLite in the same pass.  Needs :today.
+_DAYS_SQL = "CAST(julianday(fa.end_date) - julianday(fa.start_date) AS INTEGER)"
+_RATE_PA_SQL = (
+    "CASE WHEN fa.end_date > fa.start_date AND fa.amount_original > 0 "
+    "THEN (fa.interest_amount * 1.0 / fa.amount_original) "
+    f"* ({float(INTEREST_YEAR_BASIS)} / (julianday(fa.end_date) - julianday(fa.start_date))) * 100 "
+    "ELSE 0.0 END"
+)
+_ADVANCE_COLUMNS = (
+    "fa.*, cl.description as cl_description, "
+    f"{_DAYS_SQL} as days, "
+    f"{_RATE_PA_SQL} as rate_pa, "
+    "fa.start_date <= :today AND fa.end_date > :today as active "
+)
+
+
+def get_advances(conn, limit=-1, before=None, today=None):
+    """Advances newest first. `before` is the (start_date, id) of the last row
+    on the previous page; only rows sorting after it are returned."""
+    before_date, before_id = before or (None, None)
+    where = "WHERE (fa.start_date, fa.id) < (:before_date, :before_id) " if before else ""
     return conn.execute(
-        "SELECT fa.*, cl.description as cl_description "
+        "SELECT " + _ADVANCE_COLUMNS +
         "FROM fixed_advances fa "
         "LEFT JOIN credit_lines cl ON fa.credit_line_id = cl.id "
-        "ORDER BY fa.start_date DESC, fa.id DESC"
+        + where +
+        "ORDER BY fa.start_date DESC, fa.id DESC "
+        "LIMIT :limit",
+        {"before_date": before_date, "before_id": before_id, "limit": limit,
+         "today": _iso_today(today)},
     ).fetchall()
 
 
+# Flat projection for the Power BI export, columns in export.ADVANCE_COLUMNS order.
+SQL_EXPORT_ADVANCES = (
+    "SELECT fa.id, fa.bank, fa.credit_line_id, fa.currency, fa.amount_original, "
+    "fa.start_date, fa.end_date, fa.continuation_date, fa.interest_amount, "
+    f"{_DAYS_SQL} as days, ROUND({_RATE_PA_SQL}, 6) as rate_pa "
+    "FROM fixed_advances fa ORDER BY fa.id"
+)
+
+
+def count_advances(conn):
+    return conn.execute("SELECT COUNT(*) FROM fixed_advances").fetchone()[0]
+
+
 def get_advance(conn, fv_id):
     return conn.execute(
         "SELECT fa.*, cl.description as cl_description "
@@ -367,7 +676,6 @@ def create_advance(conn, data):
          data["end_date"], data["continuation_date"], data["currency"],
          data["amount_original"], data["interest_amount"]),
     )
-    conn.commit()
     return fv_id
 
 
@@ -379,65 +687,93 @@ def update_advance(conn, fv_id, data):
          data["end_date"], data["continuation_date"], data["currency"],
          data["amount_original"], data["interest_amount"], fv_id),
     )
-    conn.commit()
 
 
 def delete_advance(conn, fv_id):
     conn.execute("DELETE FROM fixed_advances WHERE id = ?", (fv_id,))
-    conn.commit()
 
 
 # ── Dashboard Queries ──
 
-def get_active_advances(conn):
-    return conn.execute(
-        "SELECT fa.*, cl.description as cl_description "
-        "FROM fixed_advances fa "
-        "LEFT JOIN credit_lines cl ON fa.credit_line_id = cl.id "
-        "WHERE fa.start_date <= date('now') AND fa.end_date > date('now') "
-        "ORDER BY fa.continuation_date ASC"
-    ).fetchall()
-
-
-def get_active_totals(conn):
-    return conn.execute(
-        "SELECT currency, SUM(amount_original) as total, COUNT(*) as count "
-        "FROM fixed_advances "
-        "WHERE start_date <= date('now') AND end_date > date('now') "
-        "GROUP BY currency"
-    ).fetchall()
-
-
-def get_upcoming_continuations(conn, limit=None):
+# Dashboard queries are module constants so each call passes sqlite3 the same
+# string, keeping the connection's prepared-statement cache warm.  "Today" is
+# bound as :today (the app's local date) rather than SQLite's UTC date('now').
+# The unary + on start_date keeps the planner off idx_fa_start (the advances
+# page ordering): almost every row has started, so end_date is the selective side.
+# Likewise "GROUP BY +currency" stops it scanning all of idx_fa_currency just to
+# avoid sorting the handful of active rows.
+_ACTIVE_ADVANCES_FROM = (
+    "SELECT " + _ADVANCE_COLUMNS +
+    "FROM fixed_advances fa "
+    "LEFT JOIN credit_lines cl ON fa.credit_line_id = cl.id "
+    "WHERE +fa.start_date <= :today AND fa.end_date > :today "
+)
+SQL_ACTIVE_ADVANCES = _ACTIVE_ADVANCES_FROM + "ORDER BY fa.continuation_date ASC"
+SQL_ACTIVE_TOTALS = (
+    "SELECT currency, SUM(amount_original) as total, COUNT(*) as count "
+    "FROM fixed_advances "
+    "WHERE +start_date <= :today AND end_date > :today "
+    "GROUP BY +currency"
+)
+SQL_UPCOMING_CONTINUATIONS = (
+    _ACTIVE_ADVANCES_FROM
+    + "AND fa.continuation_date >= :today "
+    "ORDER BY fa.continuation_date ASC"
+)
+SQL_UPCOMING_CONTINUATIONS_LIMIT = SQL_UPCOMING_CONTINUATIONS + " LIMIT :limit"
+SQL_CONTINUATION_ALERTS = (
+    _ACTIVE_ADVANCES_FROM
+    + "AND fa.continuation_date <= date(:today, '+' || :days || ' days') "
+    "AND fa.continuation_date >= :today "
+    "ORDER BY fa.continuation_date ASC"
+)
+SQL_CONTINUATIONS_FOR_MONTH = (
+    _ACTIVE_ADVANCES_FROM
+    + "AND fa.continuation_date >= :month_start AND fa.continuation_date < :month_end "
+    "ORDER BY fa.continuation_date ASC"
+)
+SQL_CL_UTILIZATION = (
+    "SELECT cl.id, cl.description, cl.currency, cl.amount as facility_amount, "
+    "COALESCE(SUM(fa.amount_original), 0) as drawn_amount "
+    "FROM credit_lines cl "
+    "LEFT JOIN fixed_advances fa ON fa.credit_line_id = cl.id "
+    "AND fa.start_date <= :today AND fa.end_date > :today "
+    "WHERE cl.archived = 0 "
+    "GROUP BY cl.id "
+    "ORDER BY cl.id"
+)
+SQL_ALL_SETTINGS = "SELECT key, value FROM settings"
+
+
+def _iso_today(today=None):
+    """ISO date string for today, or for the given date/ISO string."""
+    return str(today) if today else date.today().isoformat()
+
+
+def get_active_advances(conn, today=None):
+    return conn.execute(SQL_ACTIVE_ADVANCES, {"today": _iso_today(today)}).fetchall()
+
+
+def get_active_totals(conn, today=None):
+    return conn.execute(SQL_ACTIVE_TOTALS, {"today": _iso_today(today)}).fetchall()
+
+
+def get_upcoming_continuations(conn, limit=None, today=None):
     """Return the next active advances by continuation_date, with optional limit."""
-    sql = (
-        "SELECT fa.*, cl.description as cl_description "
-        "FROM fixed_advances fa "
-        "LEFT JOIN credit_lines cl ON fa.credit_line_id = cl.id "
-        "WHERE fa.start_date <= date('now') AND fa.end_date > date('now') "
-        "AND fa.continuation_date >= date('now') "
-        "ORDER BY fa.continuation_date ASC"
-    )
+    params = {"today": _iso_today(today)}
     if limit is not None:
-        sql += " LIMIT ?"
-        return conn.execute(sql, (limit,)).fetchall()
-    return conn.execute(sql).fetchall()
+        params["limit"] = limit
+        return conn.execute(SQL_UPCOMING_CONTINUATIONS_LIMIT, params).fetchall()
+    return conn.execute(SQL_UPCOMING_CONTINUATIONS, params).fetchall()
 
 
-def get_continuation_alerts(conn, days=7):
+def get_continuation_alerts(conn, days=7, today=None):
     return conn.execute(
-        "SELECT fa.*, cl.description as cl_description "
-        "FROM fixed_advances fa "
-        "LEFT JOIN credit_lines cl ON fa.credit_line_id = cl.id "
-        "WHERE fa.start_date <= date('now') AND fa.end_date > date('now') "
-        "AND fa.continuation_date <= date('now', '+' || ? || ' days') "
-        "AND fa.continuation_date >= date('now') "
-        "ORDER BY fa.continuation_date ASC",
-        (days,),
+        SQL_CONTINUATION_ALERTS, {"today": _iso_today(today), "days": days}
     ).fetchall()
 
 
-def get_continuations_for_month(conn, year, month):
+def get_continuations_for_month(conn, year, month, today=None):
     """Return active advances with continuation_date in the given month."""
     month_start = f"{year:04d}-{month:02d}-01"
     if month == 12:
@@ -445,37 +781,67 @@ def get_continuations_for_month(conn, year, month):
     else:
         month_end = f"{year:04d}-{month + 1:02d}-01"
     return conn.execute(
-        "SELECT fa.*, cl.description as cl_description "
-        "FROM fixed_advances fa "
-        "LEFT JOIN credit_lines cl ON fa.credit_line_id = cl.id "
-        "WHERE fa.start_date <= date('now') AND fa.end_date > date('now') "
-        "AND fa.continuation_date >= ? AND fa.continuation_date < ? "
-        "ORDER BY fa.continuation_date ASC",
-        (month_start, month_end),
+        SQL_CONTINUATIONS_FOR_MONTH,
+        {"today": _iso_today(today), "month_start": month_start, "month_end": month_end},
     ).fetchall()
 
 
+def get_dashboard_bundle(conn, alert_days, today):
+    """Run every dashboard query inside one read transaction.
+
+    Returns a dict of row lists plus the settings snapshot, so the page is
+    built from a single consistent view of the database.  ``today`` is a date;
+    its month is used for the continuation calendar.
+    """
+    iso_today = today.isoformat()
+    with read_tx(conn):
+        settings = get_all_settings(conn)
+        limit_setting = settings.get("continuation_limit", "5")
+        upcoming_limit = None if limit_setting == "all" else int(limit_setting)
+        return {
+            "settings": settings,
+            "upcoming_limit": upcoming_limit,
+            "totals": get_active_totals(conn, iso_today),
+            "alerts": get_continuation_alerts(conn, alert_days, iso_today),
+            "calendar": get_continuations_for_month(conn, today.year, today.month, iso_today),
+            "upcoming": get_upcoming_continuations(conn, upcoming_limit, iso_today),
+            "active": get_active_advances(conn, iso_today),
+            "utilization": get_cl_utilization(conn, iso_today),
+        }
+
+
+def get_advances_page_data(conn, limit=-1, before=None):
+    """Rows for the advances page (one page of advances plus the form
+    dropdowns), read in one transaction."""
+    with read_tx(conn):
+        return {
+            "advances": get_advances(conn, limit, before),
+            "total": count_advances(conn),
+            "banks": get_banks(conn),
+            "lines": get_credit_lines(conn),
+        }
+
+
+def get_credit_lines_page_data(conn):
+    """Rows for the credit lines page, read in one transaction."""
+    with read_tx(conn):
+        return {
+            "lines": get_all_credit_lines(conn),
+            "banks": get_banks(conn),
+        }
+
+
 def get_cl_drawn(conn, cl_id, exclude_fv_id=None):
-    if exclude_fv_id:
-        row = conn.execute(
-            "SELECT cl.amount as facility, COALESCE(SUM(fa.amount_original), 0) as drawn "
-            "FROM credit_lines cl "
-            "LEFT JOIN fixed_advances fa ON fa.credit_line_id = cl.id "
-            "AND fa.start_date <= date('now') AND fa.end_date > date('now') "
-            "AND fa.id != ? "
-            "WHERE cl.id = ?",
-            (exclude_fv_id, cl_id),
-        ).fetchone()
-    else:
-        row = conn.execute(
-            "SELECT cl.amount as facility, COALESCE(SUM(fa.amount_original), 0) as drawn "
-            "FROM credit_lines cl "
-            "LEFT JOIN fixed_advances fa ON fa.credit_line_id = cl.id "
-            "AND fa.start_date <= date('now') AND fa.end_date > date('now') "
-            "WHERE cl.id = ?",
-            (cl_id,),
-        ).fetchone()
-    return dict(row) if row else None
+    row = conn.execute(
+        "SELECT cl.amount as facility, COALESCE(SUM(fa.amount_original), 0) as drawn "
+        "FROM credit_lines cl "
+        "LEFT JOIN fixed_advances fa ON fa.credit_line_id = cl.id "
+        "AND fa.start_date <= :today AND fa.end_date > :today "
+        "AND (:exclude IS NULL OR fa.id != :exclude) "
+        "WHERE cl.id = :cl_id",
+        {"cl_id": cl_id, "exclude": exclude_fv_id or None, "today": _iso_today()},
+    ).fetchone()
+    return {"facility": row[0], "drawn": row[1]} if row else None
 
 
 def get_setting(conn, key, default=None):
@@ -491,50 +857,86 @@ def set_setting(conn, key, value):
         "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
         (key, value),
     )
-    conn.commit()
 
 
 def get_all_settings(conn):
     """Return all settings as a {key: value} dict."""
-    rows = conn.execute("SELECT key, value FROM settings").fetchall()
+    rows = conn.execute(SQL_ALL_SETTINGS).fetchall()
     return {r[0]: r[1] for r in rows}
 
 
-def get_cl_utilization(conn):
-    return conn.execute(
-        "SELECT cl.id, cl.description, cl.currency, cl.amount as facility_amount, "
-        "COALESCE(SUM(fa.amount_original), 0) as drawn_amount "
-        "FROM credit_lines cl "
-        "LEFT JOIN fixed_advances fa ON fa.credit_line_id = cl.id "
-        "AND fa.start_date <= date('now') AND fa.end_date > date('now') "
-        "WHERE cl.archived = 0 "
-        "GROUP BY cl.id "
-        "ORDER BY cl.id"
-    ).fetchall()
+# ── FX Rate Cache ──
+# The last successful ECB fetch, so a restarted process can serve rates
+# without waiting on the network.  Only the newest row is kept.
+
+def get_fx_cache(conn):
+    """Return (date, fetched_at, rates) of the stored ECB fetch, or None."""
+    row = conn.execute(
+        "SELECT date, fetched_at, rates_json FROM fx_cache ORDER BY date DESC LIMIT 1"
+    ).fetchone()
+    if row is None:
+        return None
+    return row[0], row[1], json.loads(row[2])
+
+
+def save_fx_cache(conn, fetch_date, fetched_at, rates):
+    """Replace the stored ECB fetch.  fetched_at is a time.time() timestamp."""
+    conn.execute("DELETE FROM fx_cache")
+    conn.execute(
+        "INSERT INTO fx_cache (date, fetched_at, rates_json) VALUES (?, ?, ?)",
+        (fetch_date, fetched_at, json.dumps(rates)),
+    )
+
+
+def get_cl_utilization(conn, today=None):
+    return conn.execute(SQL_CL_UTILIZATION, {"today": _iso_today(today)}).fetchall()
 
 
 # ── Bulk Import ──
 
+def _insert_many(conn, sql, params):
+    """Insert every row in ``params`` with one executemany.
+
+    If any row is rejected, the batch is rolled back to a savepoint and the
+    rows are retried one by one so the valid ones still land.  Returns
+    (added, errors).  Must run inside the caller's transaction: outside one,
+    RELEASE would commit the rows on its own.
+    """
+    if not conn.in_transaction:
+        raise RuntimeError("bulk inserts must run inside the caller's write_tx")
+    conn.execute("SAVEPOINT bulk_insert")
+    try:
+        try:
+            conn.executemany(sql, params)
+            return len(params), 0
+        except sqlite3.Error:
+            conn.execute("ROLLBACK TO bulk_insert")
+        added = 0
+        for p in params:
+            try:
+                conn.execute(sql, p)
+                added += 1
+            except sqlite3.Error:
+                pass
+        return added, len(params) - added
+    finally:
+        conn.execute("RELEASE bulk_insert")
+
+
 def bulk_insert_banks(conn, rows):
     """Insert banks, skipping duplicates. Returns {added, skipped}.
 
     Does NOT commit — caller is responsible for committing the transaction.
     """
-    added = 0
-    skipped = 0
-    for row in rows:
-        existing = conn.execute(
-            "SELECT bank_key FROM banks WHERE bank_key = ?", (row["bank_key"],)
-        ).fetchone()
-        if existing:
-            skipped += 1
-        else:
-            conn.execute(
-                "INSERT INTO banks (bank_key, bank_name) VALUES (?, ?)",
-                (row["bank_key"], row["bank_name"]),
-            )
-            added += 1
-    return {"added": added, "skipped": skipped}
+    before = conn.total_changes
+    conn.executemany(
+        # Only a duplicate key is skipped; other constraint violations still raise
+        "INSERT INTO banks (bank_key, bank_name) VALUES (?, ?) "
+        "ON CONFLICT(bank_key) DO NOTHING",
+        [(row["bank_key"], row["bank_name"]) for row in rows],
+    )
+    added = conn.total_changes - before
+    return {"added": added, "skipped": len(rows) - added}
 
 
 def bulk_insert_credit_lines(conn, rows):
@@ -542,22 +944,26 @@ def bulk_insert_credit_lines(conn, rows):
 
     Does NOT commit — caller is responsible for committing the transaction.
     """
-    added = 0
+    params = []
     errors = 0
     for row in rows:
         try:
-            conn.execute(
-                "INSERT INTO credit_lines (id, bank_key, description, currency, amount, "
-                "committed, start_date, end_date, note, archived) "
-                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)",
-                (row["id"], row["bank_key"], row.get("description"),
-                 row["currency"], row["amount"], row["committed"],
-                 row["start_date"], row.get("end_date"), row.get("note")),
-            )
-            added += 1
-        except Exception:
+            params.append((
+                row["id"], row["bank_key"], row.get("description"),
+                row["currency"], row["amount"], row["committed"],
+                row["start_date"], row.get("end_date"), row.get("note"),
+            ))
+        except KeyError:
             errors += 1
-    return {"added": added, "errors": errors}
+    added, failed = _insert_many(
+        conn,
+        "INSERT INTO credit_lines (id, bank_key, description, currency, amount, "
+        "committed, start_date, end_date, note, archived) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)",
+        params,
+    )
+    _ensure_sequence_row(conn, "credit_lines")
+    return {"added": added, "errors": errors + failed}
 
 
 def bulk_insert_advances(conn, rows):
@@ -565,29 +971,35 @@ def bulk_insert_advances(conn, rows):
 
     Does NOT commit — caller is responsible for committing the transaction.
     """
-    added = 0
+    params = []
     errors = 0
     for row in rows:
         try:
-            conn.execute(
-                "INSERT INTO fixed_advances (id, bank, credit_line_id, start_date, end_date, "
-                "continuation_date, currency, amount_original, interest_amount) "
-                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                (row["id"], row["bank"], row["credit_line_id"],
-                 row["start_date"], row["end_date"], row["continuation_date"],
-                 row["currency"], row["amount_original"], row["interest_amount"]),
-            )
-            added += 1
-        except Exception:
+            params.append((
+                row["id"], row["bank"], row["credit_line_id"],
+                row["start_date"], row["end_date"], row["continuation_date"],
+                row["currency"], row["amount_original"], row["interest_amount"],
+            ))
+        except KeyError:
             errors += 1
-    return {"added": added, "errors": errors}
+    added, failed = _insert_many(
+        conn,
+        "INSERT INTO fixed_advances (id, bank, credit_line_id, start_date, end_date, "
+        "continuation_date, currency, amount_original, interest_amount) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        params,
+    )
+    _ensure_sequence_row(conn, "fixed_advances")
+    return {"added": added, "errors": errors + failed}
 
 
 def clear_all_data(conn):
     """Delete all advances, credit lines, and banks (FK order).
 
-    Does NOT commit — caller is responsible for committing the transaction.
+    ID sequences are reset too, so numbering restarts after the highest
+    imported ID.  Does NOT commit — caller is responsible for committing.
     """
     conn.execute("DELETE FROM fixed_advances")
     conn.execute("DELETE FROM credit_lines")
     conn.execute("DELETE FROM banks")
+    conn.execute("DELETE FROM id_sequences")
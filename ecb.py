@@ -2,15 +2,30 @@ import urllib.request
 import urllib.error
 import json
 import logging
+import threading
+import time
 from datetime import date
 
 from config import BASE_CURRENCY
 
-_cache = {"date": None, "rates": None}
+# "expires" and "retry_at" are time.monotonic() deadlines; None means unset
+_cache = {"date": None, "rates": None, "expires": None, "retry_at": None}
 logger = logging.getLogger(__name__)
 
 # ECB publishes rates vs EUR. We fetch all ECB-available currencies
 # and convert to "BASE_CURRENCY per 1 unit of X".
+FX_CACHE_TTL = 3600  # seconds; ECB publishes once per business day
+FX_RETRY_AFTER = 60  # seconds to wait before retrying after a failed fetch
+
+# Optional (load, save) pair that keeps the last fetch across restarts; set
+# via set_store().  load() returns (date, fetched_at, rates) or None and
+# save(date, fetched_at, rates) stores one; fetched_at is a time.time() value.
+_store = None
+
+# At most one background refresh runs at a time; it holds this lock from
+# before its thread starts until the fetch has finished
+_refresh_lock = threading.Lock()
+
 ECB_BASE = "https://data-api.ecb.europa.eu/service/data/EXR/D.{codes}.EUR.SP00.A?lastNObservations=1&format=jsondata"
 
 
@@ -26,6 +41,30 @@ def clear_cache():
     """Clear daily cache so next call re-fetches from ECB."""
     _cache["date"] = None
     _cache["rates"] = None
+    _cache["expires"] = None
+    _cache["retry_at"] = None
+
+
+def set_store(load, save):
+    """Persist fetched rates through load/save (see _store); None to disable."""
+    global _store
+    _store = (load, save) if load is not None else None
+
+
+def _load_stored_rates(currency_rows):
+    """Prime an empty cache from the store, keeping what is left of its TTL."""
+    stored = _store[0]()
+    if stored is None:
+        return
+    fetch_date, fetched_at, rates = stored
+    if currency_rows is not None and any(
+        r["code"] not in rates for r in currency_rows if r["ecb_available"]
+    ):
+        return  # stored before a currency was added; fetch afresh
+    remaining = FX_CACHE_TTL - (time.time() - fetched_at)
+    _cache["date"] = fetch_date
+    _cache["rates"] = rates
+    _cache["expires"] = time.monotonic() + max(remaining, 0)
 
 
 def get_fx_rates(currency_rows=None):
@@ -35,10 +74,84 @@ def get_fx_rates(currency_rows=None):
 
     currency_rows: list of sqlite3.Row from currencies table (with code, ecb_available).
     If None, returns cached rates or base-only fallback.
+
+    Rates are reused for FX_CACHE_TTL seconds within the same day. Once they
+    go stale they are still served while a background thread re-fetches, so
+    only a cold start waits on the network; with a store set (see set_store),
+    a restarted process starts from the last stored fetch. After a failed
+    fetch the fallback is served for FX_RETRY_AFTER seconds without touching
+    the network again.
     """
+    if _cache["rates"] is None and _store is not None:
+        _load_stored_rates(currency_rows)
+
     today = date.today().isoformat()
+    now = time.monotonic()
     if _cache["date"] == today and _cache["rates"] is not None:
+        expires = _cache.get("expires")
+        if expires is None or now < expires:
+            return _cache["rates"], _cache["date"]
+
+    retry_at = _cache.get("retry_at")
+    if retry_at is not None and now < retry_at:
+        return _cache.get("rates") or {BASE_CURRENCY: 1.0}, _cache.get("date")
+
+    if _cache["rates"] is not None:
+        _refresh_in_background(currency_rows)
         return _cache["rates"], _cache["date"]
+    if _refresh_lock.locked():
+        # A prefetch is already fetching; wait for it rather than fetch twice
+        wait_for_refresh()
+        return _cache.get("rates") or {BASE_CURRENCY: 1.0}, _cache.get("date")
+    return _fetch_fx_rates(currency_rows)
+
+
+def prefetch(currency_rows):
+    """Start fetching rates in the background unless fresh ones are cached.
+
+    Called at startup so the first request does not pay for the cold fetch.
+    """
+    if _cache["rates"] is None and _store is not None:
+        _load_stored_rates(currency_rows)
+    expires = _cache.get("expires")
+    fresh = (
+        _cache["rates"] is not None
+        and _cache["date"] == date.today().isoformat()
+        and (expires is None or time.monotonic() < expires)
+    )
+    if not fresh:
+        _refresh_in_background(currency_rows)
+
+
+def _refresh_in_background(currency_rows):
+    """Start a background re-fetch unless one is already running."""
+    if not _refresh_lock.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            _fetch_fx_rates(currency_rows)
+        finally:
+            _refresh_lock.release()
+
+    threading.Thread(target=run, name="ecb-refresh", daemon=True).start()
+
+
+def wait_for_refresh(timeout=None):
+    """Block until the current background refresh (if any) has finished.
+
+    Waits on the refresh lock rather than a thread handle, so a caller that
+    sees the lock taken always waits for that fetch, even before its thread
+    has started.
+    """
+    if _refresh_lock.acquire(timeout=-1 if timeout is None else timeout):
+        _refresh_lock.release()
+
+
+def _fetch_fx_rates(currency_rows):
+    """Fetch rates from the ECB and update the cache; see get_fx_rates()."""
+    today = date.today().isoformat()
+    now = time.monotonic()
 
     # Determine which codes to fetch
     if currency_rows is not None:
@@ -59,6 +172,7 @@ def get_fx_rates(currency_rows=None):
         rates = {BASE_CURRENCY: 1.0, "EUR": 1.0}
         _cache["date"] = today
         _cache["rates"] = rates
+        _cache["expires"] = None
         return rates, today
 
     try:
@@ -67,24 +181,18 @@ def get_fx_rates(currency_rows=None):
             data = json.loads(resp.read())
 
         dataset = data["dataSets"][0]["series"]
-        dims = data["structure"]["dimensions"]["series"]
+        ccy_dim_idx, ccy_map = _currency_dimension(data)
 
-        # Find which dimension index holds CURRENCY
-        ccy_dim_idx = next(i for i, d in enumerate(dims) if d["id"] == "CURRENCY")
-        ccy_dim = dims[ccy_dim_idx]
-        ccy_map = {i: v["id"] for i, v in enumerate(ccy_dim["values"])}
+        obs_dates = data["structure"]["dimensions"]["observation"][0]["values"]
 
         raw = {}  # currency -> rate per 1 EUR
         rate_date = None
         for series_key, series_data in dataset.items():
-            parts = series_key.split(":")
-            ccy_idx = int(parts[ccy_dim_idx])
-            ccy = ccy_map[ccy_idx]
+            ccy = ccy_map[int(series_key.split(":")[ccy_dim_idx])]
             obs = series_data["observations"]
-            last_key = max(obs.keys(), key=int)
+            last_key = max(obs, key=int)
             raw[ccy] = obs[last_key][0]
             if rate_date is None:
-                obs_dates = data["structure"]["dimensions"]["observation"][0]["values"]
                 rate_date = obs_dates[int(last_key)]["id"]
 
         # Convert everything to "BASE_CURRENCY per 1 unit of currency"
@@ -100,6 +208,10 @@ def get_fx_rates(currency_rows=None):
 
         _cache["date"] = today
         _cache["rates"] = rates
+        _cache["expires"] = now + FX_CACHE_TTL
+        _cache["retry_at"] = None
+        if _store is not None:
+            _store[1](today, time.time(), rates)
         return rates, rate_date
     except (
         OSError,
@@ -112,31 +224,47 @@ def get_fx_rates(currency_rows=None):
         TypeError,
     ) as exc:
         logger.warning("ECB FX fetch failed, using fallback cache/base rate: %s", exc)
+        _cache["retry_at"] = now + FX_RETRY_AFTER
         return _cache.get("rates") or {BASE_CURRENCY: 1.0}, _cache.get("date")
 
 
+def _currency_dimension(data):
+    """(position of CURRENCY in series keys, {value index: currency code})."""
+    dims = data["structure"]["dimensions"]["series"]
+    ccy_dim_idx = next(i for i, d in enumerate(dims) if d["id"] == "CURRENCY")
+    ccy_map = {i: v["id"] for i, v in enumerate(dims[ccy_dim_idx]["values"])}
+    return ccy_dim_idx, ccy_map
+
+
 def get_eur_chf_rate():
     """Backwards-compatible: returns (eur_chf_rate, date_str)."""
     rates, rate_date = get_fx_rates()
     return rates.get("EUR"), rate_date
 
 
-def validate_currency_ecb(code):
-    """Check if ECB publishes rates for a given currency code.
-    Returns (is_available: bool, error_msg: str|None).
+def validate_currencies_ecb(codes):
+    """Check several currency codes against the ECB with a single request.
+
+    Returns {code: is_available} for the upper-cased codes, or None if the
+    ECB could not be reached or answered with something unreadable.
     """
-    if code.upper() == "EUR":
-        return True, None
-    test_url = ECB_BASE.format(codes=code.upper())
+    codes = {c.upper() for c in codes}
+    result = {c: c == "EUR" for c in codes}
+    url = _build_ecb_url(codes)
+    if url is None:
+        return result
     try:
-        req = urllib.request.Request(test_url, headers={"Accept": "application/json"})
+        req = urllib.request.Request(url, headers={"Accept": "application/json"})
         with urllib.request.urlopen(req, timeout=5) as resp:
             data = json.loads(resp.read())
-        # If we get data with observations, it's valid
-        dataset = data.get("dataSets", [{}])[0].get("series", {})
-        if dataset:
-            return True, None
-        return False, f"ECB does not publish rates for {code.upper()}"
+        series = data.get("dataSets", [{}])[0].get("series", {})
+        if series:
+            ccy_dim_idx, ccy_map = _currency_dimension(data)
+            for series_key in series:
+                ccy = ccy_map[int(series_key.split(":")[ccy_dim_idx])]
+                if ccy in result:
+                    result[ccy] = True
+        return result
     except (
         OSError,
         urllib.error.URLError,
@@ -146,6 +274,20 @@ def validate_currency_ecb(code):
         IndexError,
         ValueError,
         TypeError,
+        StopIteration,
     ) as exc:
-        logger.warning("ECB currency validation failed for %s: %s", code.upper(), exc)
-        return False, f"Could not verify {code.upper()} against ECB (network error or unsupported currency)"
+        logger.warning("ECB currency validation failed for %s: %s", "+".join(sorted(codes)), exc)
+        return None
+
+
+def validate_currency_ecb(code):
+    """Check if ECB publishes rates for a given currency code.
+    Returns (is_available: bool, error_msg: str|None).
+    """
+    code = code.upper()
+    result = validate_currencies_ecb([code])
+    if result is None:
+        return False, f"Could not verify {code} against ECB (network error or unsupported currency)"
+    if result[code]:
+        return True, None
+    return False, f"ECB does not publish rates for {code}"
@@ -1,12 +1,18 @@
+import itertools
 import logging
+import math
 import os
+import queue
+import re
 import tempfile
-
-from openpyxl import Workbook
+import threading
+import time
+import zipfile
+from datetime import datetime
+from xml.sax.saxutils import escape
 
 import db
 from config import EXPORT_PATH
-from helpers import calc_days, calc_interest_rate_pa
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +29,118 @@ CREDIT_LINE_COLUMNS = [
     "committed", "start_date", "end_date", "note", "archived",
 ]
 
+_SQL_EXPORT_CREDIT_LINES = (
+    "SELECT " + ", ".join(CREDIT_LINE_COLUMNS) + " FROM credit_lines ORDER BY id"
+)
+
+
+# Minimal SpreadsheetML package parts.  The sheets carry plain values only
+# (no styles, shared strings or formulas), so the XML is written directly
+# instead of building a cell object per value through openpyxl.
+_CONTENT_TYPES_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '{overrides}</Types>'
+)
+_SHEET_OVERRIDE_XML = (
+    '<Override PartName="/xl/worksheets/sheet{n}.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+)
+_ROOT_RELS_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/></Relationships>'
+)
+_WORKBOOK_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets>{sheets}</sheets></workbook>'
+)
+_WORKBOOK_SHEET_XML = '<sheet name="{name}" sheetId="{n}" r:id="rId{n}"/>'
+_WORKBOOK_RELS_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '{rels}</Relationships>'
+)
+_WORKBOOK_REL_XML = (
+    '<Relationship Id="rId{n}" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet{n}.xml"/>'
+)
+_SHEET_HEAD_XML = (
+    b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+)
+_SHEET_TAIL_XML = b"</sheetData></worksheet>"
+
+# Control characters XML 1.0 cannot carry, even escaped
+_ILLEGAL_XML_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def _cell_xml(ref, value):
+    """One <c> element; None becomes an empty (omitted) cell."""
+    if value is None:
+        return ""
+    # bool is an int but has no numeric cell form; inf/nan are not valid <v> numbers
+    if (isinstance(value, (int, float)) and not isinstance(value, bool)
+            and math.isfinite(value)):
+        return f'<c r="{ref}"><v>{value!r}</v></c>'
+    text = escape(_ILLEGAL_XML_CHARS.sub("", str(value)))
+    return f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _column_letter(i):
+    """Spreadsheet column name for 0-based index i: A..Z, AA..AZ, BA..."""
+    letters = ""
+    i += 1
+    while i:
+        i, rem = divmod(i - 1, 26)
+        letters = chr(ord("A") + rem) + letters
+    return letters
+
+
+def _write_sheet(zf, n, header, rows):
+    """Stream header plus rows into xl/worksheets/sheet{n}.xml."""
+    letters = [_column_letter(i) for i in range(len(header))]
+    with zf.open(f"xl/worksheets/sheet{n}.xml", "w") as f:
+        f.write(_SHEET_HEAD_XML)
+        for r, row in enumerate(itertools.chain([header], rows), 1):
+            cells = "".join(_cell_xml(f"{col}{r}", v) for col, v in zip(letters, row))
+            f.write(f'<row r="{r}">{cells}</row>'.encode())
+        f.write(_SHEET_TAIL_XML)
+
+
+def _write_xlsx(path, sheets):
+    """Write an .xlsx file from [(sheet_name, header, rows), ...]."""
+    names = [name for name, _, _ in sheets]
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("[Content_Types].xml", _CONTENT_TYPES_XML.format(overrides="".join(
+            _SHEET_OVERRIDE_XML.format(n=n) for n in range(1, len(names) + 1))))
+        zf.writestr("_rels/.rels", _ROOT_RELS_XML)
+        zf.writestr("xl/workbook.xml", _WORKBOOK_XML.format(sheets="".join(
+            _WORKBOOK_SHEET_XML.format(name=escape(name), n=n)
+            for n, name in enumerate(names, 1))))
+        zf.writestr("xl/_rels/workbook.xml.rels", _WORKBOOK_RELS_XML.format(rels="".join(
+            _WORKBOOK_REL_XML.format(n=n) for n in range(1, len(names) + 1))))
+        for n, (_, header, rows) in enumerate(sheets, 1):
+            _write_sheet(zf, n, header, rows)
+
+
+def _advance_rows(conn):
+    """tblFV rows; days and rate_pa are computed by db.SQL_EXPORT_ADVANCES."""
+    for row in conn.execute(db.SQL_EXPORT_ADVANCES):
+        if row["days"] is None:
+            logger.warning("Skipping advance %s: bad date or amount data", row["id"])
+            row = tuple(row)[:-1] + (None,)
+        yield row
+
 
 def export_xlsx(export_path=None):
     """Export fixed_advances and credit_lines to an xlsx file for Power BI.
@@ -31,61 +149,94 @@ def export_xlsx(export_path=None):
         export_path: Optional directory override. If None, reads from DB settings
                      then falls back to config.EXPORT_PATH.
     """
-    conn = db.get_db()
-    try:
+    with db.get_pool().reader() as conn, db.read_tx(conn):
         if export_path is None:
             export_path = db.get_setting(conn, "export_path", default=EXPORT_PATH)
-        advances = conn.execute("SELECT * FROM fixed_advances ORDER BY id").fetchall()
-        credit_lines = conn.execute("SELECT * FROM credit_lines ORDER BY id").fetchall()
-    finally:
-        conn.close()
-
-    export_dir = export_path
-    export_file = os.path.join(export_dir, "tenordash.xlsx")
-
-    wb = Workbook()
 
-    # Sheet 1: tblFV (fixed advances with calculated fields)
-    ws_fv = wb.active
-    ws_fv.title = "tblFV"
-    ws_fv.append(ADVANCE_COLUMNS)
+        export_dir = export_path
+        export_file = os.path.join(export_dir, "tenordash.xlsx")
 
-    for row in advances:
-        d = dict(row)
+        # Atomic write: write to temp file then rename
+        os.makedirs(export_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".xlsx", dir=export_dir)
+        os.close(fd)
         try:
-            days = calc_days(d["start_date"], d["end_date"])
-            rate_pa = calc_interest_rate_pa(d["interest_amount"], d["amount_original"], days)
-        except (ValueError, TypeError, KeyError):
-            logger.warning("Skipping advance %s: bad date or amount data", d.get("id"))
-            days = None
-            rate_pa = None
-        ws_fv.append([
-            d["id"], d["bank"], d["credit_line_id"], d["currency"],
-            d["amount_original"], d["start_date"], d["end_date"],
-            d["continuation_date"], d["interest_amount"], days,
-            round(rate_pa, 6) if rate_pa is not None else None,
-        ])
-
-    # Sheet 2: tblCreditLines
-    ws_cl = wb.create_sheet("tblCreditLines")
-    ws_cl.append(CREDIT_LINE_COLUMNS)
-
-    for row in credit_lines:
-        d = dict(row)
-        ws_cl.append([d.get(col) for col in CREDIT_LINE_COLUMNS])
-
-    # Atomic write: write to temp file then rename
-    os.makedirs(export_dir, exist_ok=True)
-    fd, tmp_path = tempfile.mkstemp(suffix=".xlsx", dir=export_dir)
-    os.close(fd)
-    try:
-        wb.save(tmp_path)
-        os.replace(tmp_path, export_file)
-    except Exception:
-        # Clean up temp file on failure
-        try:
-            os.unlink(tmp_path)
-        except OSError:
-            pass
-        logger.exception("Failed to write export file")
-        raise
+            # Rows go straight from the cursors into the file, so neither
+            # table is held in memory; the read transaction keeps them consistent.
+            _write_xlsx(tmp_path, [
+                ("tblFV", ADVANCE_COLUMNS, _advance_rows(conn)),
+                ("tblCreditLines", CREDIT_LINE_COLUMNS, conn.execute(_SQL_EXPORT_CREDIT_LINES)),
+            ])
+            os.replace(tmp_path, export_file)
+        except Exception:
+            # Clean up temp file on failure
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            logger.exception("Failed to write export file")
+            raise
+
+
+class ExportWorker:
+    """Run export_xlsx on a background thread so write requests never wait on it.
+
+    Requests that arrive while an export is pending are coalesced: the worker
+    sleeps for ``debounce`` seconds, drains the queue, and exports once using
+    the most recently requested path.
+    """
+
+    def __init__(self, debounce=0.5):
+        self.debounce = debounce
+        self.last_error = None
+        self.last_export = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, export_path=None):
+        """Queue an export; None means use the path from settings."""
+        self._ensure_running()
+        self._queue.put(export_path)
+
+    def wait(self):
+        """Block until every queued export has finished."""
+        self._queue.join()
+
+    def status(self):
+        return {
+            "pending": self._queue.unfinished_tasks > 0,
+            "last_export": self.last_export,
+            "error": self.last_error,
+        }
+
+    def _ensure_running(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="tenordash-export", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            export_path = self._queue.get()
+            taken = 1
+            if self.debounce:
+                time.sleep(self.debounce)
+            while True:
+                try:
+                    export_path = self._queue.get_nowait()
+                    taken += 1
+                except queue.Empty:
+                    break
+            try:
+                export_xlsx(export_path=export_path)
+                self.last_error = None
+                self.last_export = datetime.now().isoformat(timespec="seconds")
+            except Exception:
+                logger.exception("Auto-export failed")
+                self.last_error = "Auto-export failed — see server log for details"
+            finally:
+                for _ in range(taken):
+                    self._queue.task_done()
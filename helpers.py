@@ -16,21 +16,31 @@ def calc_interest_rate_pa(interest_amount, amount_original, days):
     return (interest_amount / amount_original) * (INTEREST_YEAR_BASIS / days) * 100
 
 
+def _business_days_back_offset(weekday, business_days):
+    """Calendar days from a `weekday` (0=Mon) back to `business_days` weekdays earlier."""
+    offset = 0
+    while business_days:
+        offset += 1
+        if (weekday - offset) % 7 < 5:  # Mon-Fri
+            business_days -= 1
+    return offset
+
+
+# The offset only depends on the end date's weekday, so it is worked out once
+_CONTINUATION_OFFSETS = tuple(
+    timedelta(days=_business_days_back_offset(w, CONTINUATION_DAYS)) for w in range(7)
+)
+
+
 def suggest_continuation_date(end_date_str):
     """Suggest continuation date: 3 business days before end date (skip weekends)."""
     end = date.fromisoformat(end_date_str)
-    bdays = 0
-    current = end
-    while bdays < CONTINUATION_DAYS:
-        current -= timedelta(days=1)
-        if current.weekday() < 5:  # Mon-Fri
-            bdays += 1
-    return current.isoformat()
-
-
-def is_currently_active(start_date_str, end_date_str):
-    """Check if advance is currently active."""
-    today = date.today()
+    return (end - _CONTINUATION_OFFSETS[end.weekday()]).isoformat()
+
+
+def is_currently_active(start_date_str, end_date_str, today=None):
+    """Check if advance is active on `today` (a date; defaults to the current day)."""
+    today = today or date.today()
     start = date.fromisoformat(start_date_str)
     end = date.fromisoformat(end_date_str)
     return start <= today < end
@@ -56,12 +66,21 @@ def format_amount(amount):
     return f"{amount:,.0f}"
 
 
-def enrich_advance(row):
-    """Add calculated fields to an advance dict."""
+def format_amount_for_unit(amount, unit):
+    """Format an integer amount for the display_unit setting (full/thousands/millions)."""
+    if unit == "full":
+        return f"{amount:,}"
+    if unit == "thousands":
+        return format_amount_thousands(amount)
+    return format_amount_short(amount)
+
+
+def enrich_advance(row, today=None):
+    """Add calculated fields to an advance dict; see is_currently_active for `today`."""
     d = dict(row)
     d["days"] = calc_days(d["start_date"], d["end_date"])
     d["rate_pa"] = calc_interest_rate_pa(
         d["interest_amount"], d["amount_original"], d["days"]
     )
-    d["active"] = is_currently_active(d["start_date"], d["end_date"])
+    d["active"] = is_currently_active(d["start_date"], d["end_date"], today)
     return d
@@ -1,4 +1,5 @@
 from datetime import date, datetime
+from operator import itemgetter
 
 from openpyxl import load_workbook
 
@@ -29,9 +30,13 @@ ADV_COLUMN_MAP = {
     "Interest Amount": "interest_amount",
 }
 
-CL_REQUIRED = {"id", "bank_key", "currency", "amount", "committed", "start_date"}
-ADV_REQUIRED = {"id", "bank", "credit_line_id", "start_date", "end_date",
-                "continuation_date", "currency", "amount_original", "interest_amount"}
+# Header lookups for _parse_sheet, keyed on the stripped header text
+_CL_HEADERS = {k.strip(): v for k, v in CL_COLUMN_MAP.items()}
+_ADV_HEADERS = {k.strip(): v for k, v in ADV_COLUMN_MAP.items()}
+
+CL_REQUIRED = frozenset({"id", "bank_key", "currency", "amount", "committed", "start_date"})
+ADV_REQUIRED = frozenset({"id", "bank", "credit_line_id", "start_date", "end_date",
+                          "continuation_date", "currency", "amount_original", "interest_amount"})
 
 
 def _normalize_date(value):
@@ -68,77 +73,104 @@ def _normalize_amount(value):
 
 
 def _parse_sheet(ws, column_map, header_row=4):
-    """Parse a worksheet using column_map to rename headers. Returns list of dicts."""
-    headers_raw = [cell.value for cell in ws[header_row]]
+    """Parse a worksheet using column_map to rename headers. Returns list of dicts.
+
+    column_map is keyed on stripped header text (see _CL_HEADERS).
+    """
+    # One pass over plain values: the header row first, then the data rows
+    values = ws.iter_rows(min_row=header_row, values_only=True)
+    headers_raw = next(values, ())
     # Map Excel headers to DB field names
     col_indices = {}
     for idx, header in enumerate(headers_raw):
-        if header and header.strip() in column_map:
-            col_indices[idx] = column_map[header.strip()]
-        elif header and header in column_map:
-            col_indices[idx] = column_map[header]
+        key = header.strip() if isinstance(header, str) else header
+        if key in column_map:
+            col_indices[idx] = column_map[key]
+
+    indices = tuple(col_indices)
+    fields = tuple(col_indices.values())
+    width = max(indices, default=-1) + 1
+    # itemgetter pulls every mapped cell of a row in one C call.  With no
+    # recognised headers every row still becomes an all-None record, so
+    # validation reports the missing fields instead of showing an empty sheet
+    if len(indices) > 1:
+        pick = itemgetter(*indices)
+    elif indices:
+        pick = lambda r: (r[indices[0]],)
+    else:
+        pick = lambda r: ()
+    has_id = "id" in fields
+    # Every mapped field is present (None if its column is missing) so the
+    # normalizers can index rows directly
+    blank = dict.fromkeys(column_map.values())
 
     rows = []
-    for row in ws.iter_rows(min_row=header_row + 1, values_only=True):
+    for row in values:
         # Skip completely empty rows
-        if all(v is None for v in row):
+        if row.count(None) == len(row):
             continue
-        record = {}
-        for idx, field in col_indices.items():
-            record[field] = row[idx] if idx < len(row) else None
+        if len(row) < width:
+            row = row + (None,) * (width - len(row))
+        record = blank.copy()
+        record.update(zip(fields, pick(row)))
         # Skip rows where ID is empty (padding rows)
-        id_field = "id" if "id" in record else None
-        if id_field and not record.get(id_field):
+        if has_id and not record["id"]:
             continue
         rows.append(record)
 
     return rows
 
 
+def _strip_fields(row, fields):
+    """Strip the given string fields in place, converting non-strings first."""
+    for f in fields:
+        v = row[f]
+        if v is not None:
+            row[f] = v.strip() if isinstance(v, str) else str(v).strip()
+
+
+_CL_STR_FIELDS = ("id", "bank_key", "description", "currency", "note")
+_ADV_STR_FIELDS = ("id", "bank", "credit_line_id", "currency")
+
+
 def _normalize_credit_line(row):
     """Normalize a credit line row's types."""
-    row["start_date"] = _normalize_date(row.get("start_date"))
-    row["end_date"] = _normalize_date(row.get("end_date"))
-    row["amount"] = _normalize_amount(row.get("amount"))
-    if row["amount"] is not None:
-        row["amount"] = int(row["amount"])
+    row["start_date"] = _normalize_date(row["start_date"])
+    row["end_date"] = _normalize_date(row["end_date"])
+    amount = _normalize_amount(row["amount"])
+    row["amount"] = int(amount) if amount is not None else None
     # Normalize committed to Yes/No
-    committed = str(row.get("committed", "")).strip()
+    committed = str(row["committed"]).strip()
     row["committed"] = "Yes" if committed.lower() in ("yes", "y", "1", "true") else "No"
-    # Strip string fields
-    for f in ("id", "bank_key", "description", "currency", "note"):
-        if row.get(f) is not None:
-            row[f] = str(row[f]).strip()
+    _strip_fields(row, _CL_STR_FIELDS)
     return row
 
 
 def _normalize_advance(row):
     """Normalize an advance row's types."""
     for f in ("start_date", "end_date", "continuation_date"):
-        row[f] = _normalize_date(row.get(f))
-    row["amount_original"] = _normalize_amount(row.get("amount_original"))
-    if row["amount_original"] is not None:
-        row["amount_original"] = int(row["amount_original"])
-    row["interest_amount"] = _normalize_amount(row.get("interest_amount"))
-    if row["interest_amount"] is not None:
-        row["interest_amount"] = float(row["interest_amount"])
-    # Strip string fields
-    for f in ("id", "bank", "credit_line_id", "currency"):
-        if row.get(f) is not None:
-            row[f] = str(row[f]).strip()
+        row[f] = _normalize_date(row[f])
+    amount = _normalize_amount(row["amount_original"])
+    row["amount_original"] = int(amount) if amount is not None else None
+    interest = _normalize_amount(row["interest_amount"])
+    row["interest_amount"] = float(interest) if interest is not None else None
+    _strip_fields(row, _ADV_STR_FIELDS)
     return row
 
 
 def _extract_banks(credit_lines, advances):
     """Extract unique banks from credit lines (bank_key) and advances (bank name)."""
-    bank_keys = {}
+    # One pass over credit lines collects the bank keys (in first-seen order)
+    # and the credit_line_id → bank_key lookup
+    bank_names = {}
+    cl_to_bk = {}
     for cl in credit_lines:
         bk = cl.get("bank_key")
         if bk:
-            bank_keys.setdefault(bk, None)
-
-    # Build credit_line_id → bank_key lookup
-    cl_to_bk = {cl["id"]: cl["bank_key"] for cl in credit_lines if cl.get("id") and cl.get("bank_key")}
+            bank_names.setdefault(bk, None)
+            cl_id = cl.get("id")
+            if cl_id:
+                cl_to_bk[cl_id] = bk
 
     # From advances, map bank names to bank_keys via credit_line_id
     for adv in advances:
@@ -146,23 +178,17 @@ def _extract_banks(credit_lines, advances):
         bank_name = adv.get("bank")
         if cl_id and bank_name and cl_id in cl_to_bk:
             bk = cl_to_bk[cl_id]
-            if bk in bank_keys and bank_keys[bk] is None:
-                bank_keys[bk] = bank_name
+            if bank_names[bk] is None:
+                bank_names[bk] = bank_name
 
     # Fill any remaining None names with bank_key as fallback
-    rows = []
-    for bk, name in bank_keys.items():
-        rows.append({"bank_key": bk, "bank_name": name or bk})
-
-    return rows
+    return [{"bank_key": bk, "bank_name": name or bk} for bk, name in bank_names.items()]
 
 
 def validate_credit_line(row):
     """Validate a credit line row. Returns list of error strings."""
-    errors = []
-    for field in CL_REQUIRED:
-        if not row.get(field):
-            errors.append(f"Missing required field: {field}")
+    present = {k for k, v in row.items() if v}
+    errors = [f"Missing required field: {field}" for field in CL_REQUIRED - present]
     if row.get("amount") is not None and not isinstance(row["amount"], (int, float)):
         errors.append("Amount must be numeric")
     if row.get("start_date"):
@@ -175,10 +201,9 @@ def validate_credit_line(row):
 
 def validate_advance(row):
     """Validate an advance row. Returns list of error strings."""
-    errors = []
-    for field in ADV_REQUIRED:
-        if not row.get(field) and row.get(field) != 0:
-            errors.append(f"Missing required field: {field}")
+    # Zero is a value here (e.g. interest_amount); other falsy values count as missing
+    present = {k for k, v in row.items() if v or v == 0}
+    errors = [f"Missing required field: {field}" for field in ADV_REQUIRED - present]
     if row.get("amount_original") is not None and not isinstance(row["amount_original"], (int, float)):
         errors.append("Amount must be numeric")
     if row.get("interest_amount") is not None and not isinstance(row["interest_amount"], (int, float)):
@@ -215,7 +240,7 @@ def parse_excel(filepath):
                 cl_sheet_name = name
                 break
         if cl_sheet_name:
-            raw_cls = _parse_sheet(wb[cl_sheet_name], CL_COLUMN_MAP)
+            raw_cls = _parse_sheet(wb[cl_sheet_name], _CL_HEADERS)
             for i, row in enumerate(raw_cls):
                 row = _normalize_credit_line(row)
                 errors = validate_credit_line(row)
@@ -231,7 +256,7 @@ def parse_excel(filepath):
                 adv_sheet_name = name
                 break
         if adv_sheet_name:
-            raw_advs = _parse_sheet(wb[adv_sheet_name], ADV_COLUMN_MAP)
+            raw_advs = _parse_sheet(wb[adv_sheet_name], _ADV_HEADERS)
             for i, row in enumerate(raw_advs):
                 row = _normalize_advance(row)
                 errors = validate_advance(row)
@@ -0,0 +1,68 @@
+"""Fresh, fully initialised test databases without re-running init_db each time.
+
+The schema is built once per test run into a template file; every caller gets
+a page-for-page copy of it, which is much cheaper than replaying the DDL.
+The small fixtures the app-level tests share live here too.
+"""
+import atexit
+from contextlib import contextmanager
+from datetime import date
+import os
+import sqlite3
+import tempfile
+
+import db
+import ecb
+
+_template_path = None
+
+
+@contextmanager
+def override_db_path(path):
+    """Point db.DB_PATH at path inside the block; use with TestCase.enterContext."""
+    orig_db_path = db.DB_PATH
+    db.DB_PATH = path
+    try:
+        yield path
+    finally:
+        db.DB_PATH = orig_db_path
+
+
+def _build_template():
+    global _template_path
+    tmpdir = tempfile.TemporaryDirectory()
+    atexit.register(tmpdir.cleanup)
+    path = os.path.join(tmpdir.name, "template.db")
+    with override_db_path(path):
+        db.init_db()
+    _template_path = path
+
+
+def copy_template_db(path):
+    """Write an initialised database (schema, seeds, indexes) to path."""
+    if _template_path is None:
+        _build_template()
+    src = sqlite3.connect(_template_path)
+    dst = sqlite3.connect(path)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def prime_fx_cache(test):
+    """Serve today's FX rates from ecb's cache so rendering never reaches the ECB API."""
+    test.addCleanup(ecb.clear_cache)
+    ecb._cache["date"] = date.today().isoformat()
+    ecb._cache["rates"] = {"CHF": 1.0, "EUR": 0.95}
+
+
+def run_exports_immediately(test, worker):
+    """Export without the worker's debounce; the test's cleanup waits for queued exports.
+
+    Call after switching the database so the wait runs before it is swapped back.
+    """
+    test.addCleanup(setattr, worker, "debounce", worker.debounce)
+    worker.debounce = 0
+    test.addCleanup(worker.wait)
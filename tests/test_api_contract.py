@@ -1,9 +1,15 @@
+from datetime import date, timedelta
+import json
 import os
 import tempfile
 import unittest
 import importlib.util
 
 import db
+from db_template import (
+    copy_template_db, override_db_path, prime_fx_cache, run_exports_immediately,
+)
+import ecb
 
 if importlib.util.find_spec("flask") is not None:
     import app as app_module
@@ -13,15 +19,25 @@ else:
 
 @unittest.skipUnless(app_module is not None, "flask is not installed in this environment")
 class ApiContractTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        config = app_module.app.config
+        cls.addClassCleanup(config.__setitem__, "TESTING", config.get("TESTING"))
+        cls.addClassCleanup(
+            config.__setitem__, "PROPAGATE_EXCEPTIONS", config.get("PROPAGATE_EXCEPTIONS")
+        )
+        config["TESTING"] = True
+        config["PROPAGATE_EXCEPTIONS"] = False
+        cls.client = app_module.app.test_client()
+
     def setUp(self):
         tmpdir = tempfile.TemporaryDirectory()
         self.addCleanup(tmpdir.cleanup)
         db_path = os.path.join(tmpdir.name, "test_api.db")
 
-        orig_db_path = db.DB_PATH
-        self.addCleanup(setattr, db, "DB_PATH", orig_db_path)
-        db.DB_PATH = db_path
-        db.init_db()
+        self.enterContext(override_db_path(db_path))
+        copy_template_db(db_path)
+        self.addCleanup(db.close_pool)
 
         conn = db.get_db()
         try:
@@ -33,13 +49,7 @@ class ApiContractTests(unittest.TestCase):
         finally:
             conn.close()
 
-        orig_testing = app_module.app.config.get("TESTING")
-        orig_propagate = app_module.app.config.get("PROPAGATE_EXCEPTIONS")
-        self.addCleanup(app_module.app.config.__setitem__, "TESTING", orig_testing)
-        self.addCleanup(app_module.app.config.__setitem__, "PROPAGATE_EXCEPTIONS", orig_propagate)
-        app_module.app.config["TESTING"] = True
-        app_module.app.config["PROPAGATE_EXCEPTIONS"] = False
-        self.client = app_module.app.test_client()
+        run_exports_immediately(self, app_module.export_worker)
 
     def _credit_line_payload(self):
         return {
@@ -91,9 +101,56 @@ class ApiContractTests(unittest.TestCase):
         res = self.client.get("/api/check-cl-capacity?cl_id=CL001&amount=not-a-number")
         self.assertEqual(res.status_code, 400)
 
+    @unittest.skipIf(getattr(app_module, "orjson", None) is None, "orjson not installed")
+    def test_orjson_provider_matches_default_output(self):
+        payload = {"ok": True, "b": [1, 2.5, None], "a": "Zürich", 3: "x"}
+        self.assertIsInstance(app_module.app.json, app_module.OrjsonProvider)
+        self.assertEqual(
+            json.loads(app_module.app.json.dumps(payload)),
+            json.loads(json.dumps(payload)),
+        )
+        self.assertTrue(app_module.app.json.dumps(payload).startswith('{"3":'))
+
+    def test_json_provider_serializes_sqlite_rows(self):
+        conn = db.get_db()
+        try:
+            row = db.get_bank(conn, "B001")
+        finally:
+            conn.close()
+        expected = {"bank_key": "B001", "bank_name": "Bank 1"}
+        for provider in (app_module.app.json, app_module.RowJSONProvider(app_module.app)):
+            self.assertEqual(json.loads(provider.dumps(row)), expected)
+
+    def test_list_currencies_streams_json_array(self):
+        res = self.client.get("/api/currencies")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, "application/json")
+        codes = [c["code"] for c in res.get_json()]
+        self.assertIn("CHF", codes)
+        self.assertEqual(len(codes), len(set(codes)))
+
+    def test_currency_cache_refreshes_after_delete(self):
+        codes = [r["code"] for r in app_module.get_currencies_cached()]
+        self.assertIn("PLN", codes)
+        self.assertIs(app_module.get_currencies_cached(), app_module.get_currencies_cached())
+
+        self.assertEqual(self.client.delete("/api/currencies/PLN").status_code, 200)
+        codes = [r["code"] for r in app_module.get_currencies_cached()]
+        self.assertNotIn("PLN", codes)
+
+    def test_currency_in_use_cannot_be_deleted(self):
+        payload = self._credit_line_payload()
+        payload["currency"] = "EUR"
+        self.assertEqual(self.client.post("/credit-lines", json=payload).status_code, 200)
+
+        res = self.client.delete("/api/currencies/EUR")
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(self.client.delete("/api/currencies/GBP").status_code, 200)
+
     def test_currency_api_invalid_and_duplicate(self):
-        res = self.client.post("/api/currencies", json={"code": "US"})
-        self.assertEqual(res.status_code, 400)
+        for code in ("US", "US1", "ÄBC", "USDX"):
+            res = self.client.post("/api/currencies", json={"code": code})
+            self.assertEqual(res.status_code, 400, code)
 
         res = self.client.post("/api/currencies", json={"code": "CHF"})
         self.assertEqual(res.status_code, 409)
@@ -109,6 +166,12 @@ class ApiContractTests(unittest.TestCase):
         )
         self.assertEqual(res.status_code, 400)
 
+    def test_bank_fields_must_be_non_empty_strings(self):
+        for payload in ({"bank_key": 7, "bank_name": "Bank 7"}, {"bank_key": "B007", "bank_name": "  "}):
+            res = self.client.post("/banks", json=payload)
+            self.assertEqual(res.status_code, 400)
+            self.assertIn("non-empty string", res.get_json()["error"])
+
     def test_bank_happy_path(self):
         res = self.client.post("/banks", json={"bank_key": "B002", "bank_name": "Bank 2"})
         self.assertEqual(res.status_code, 200)
@@ -169,6 +232,160 @@ class ApiContractTests(unittest.TestCase):
         self.assertIn("new_drawn", body)
         self.assertIn("exceeded", body)
 
+    def test_check_cl_capacity_excludes_edited_advance(self):
+        cl_id = self._create_credit_line()
+        today = date.today()
+        payload = self._advance_payload(cl_id)
+        payload["start_date"] = (today - timedelta(days=10)).isoformat()
+        payload["end_date"] = (today + timedelta(days=20)).isoformat()
+        fv_id = self.client.post("/advances", json=payload).get_json()["id"]
+
+        body = self.client.get(f"/api/check-cl-capacity?cl_id={cl_id}&amount=0").get_json()
+        self.assertEqual(body["current_drawn"], payload["amount_original"])
+
+        body = self.client.get(
+            f"/api/check-cl-capacity?cl_id={cl_id}&amount=0&exclude={fv_id}"
+        ).get_json()
+        self.assertEqual(body["current_drawn"], 0)
+
+    def test_template_globals_loaded_once_per_request(self):
+        prime_fx_cache(self)
+
+        with app_module.app.test_request_context("/"):
+            first = app_module.inject_globals()
+            second = app_module.inject_globals()
+        self.assertIs(first, second)
+        self.assertIn("CHF", [c["code"] for c in first["currencies"]])
+
+    def test_continuation_calendar_api_marks_advance(self):
+        cl_id = self._create_credit_line()
+        today = date.today()
+        payload = self._advance_payload(cl_id)
+        payload["start_date"] = (today - timedelta(days=10)).isoformat()
+        payload["end_date"] = (today + timedelta(days=20)).isoformat()
+        payload["continuation_date"] = today.isoformat()
+        self.assertEqual(self.client.post("/advances", json=payload).status_code, 200)
+
+        res = self.client.get(f"/api/continuation-calendar?year={today.year}&month={today.month}")
+        self.assertEqual(res.status_code, 200)
+        cal = res.get_json()["calendar"]
+        self.assertEqual(len(cal["days"]), len(cal["marked_mask"]))
+        marked = [cal["dates"][i] for i, m in enumerate(cal["marked_mask"]) if m]
+        self.assertEqual(marked, [today.isoformat()])
+        self.assertEqual(cal["dates"][cal["today_idx"]], today.isoformat())
+
+    def test_active_queries_use_bound_today(self):
+        cl_id = self._create_credit_line()
+        self.client.post("/advances", json=self._advance_payload(cl_id))
+
+        conn = db.get_db()
+        try:
+            during = db.get_active_totals(conn, "2026-01-20")
+            after = db.get_active_totals(conn, "2026-02-10")
+            self.assertEqual([(r["currency"], r["count"]) for r in during], [("CHF", 1)])
+            self.assertEqual(after, [])
+            self.assertEqual(len(db.get_continuation_alerts(conn, 7, "2026-02-01")), 1)
+            self.assertEqual(len(db.get_continuation_alerts(conn, 7, "2026-01-20")), 0)
+        finally:
+            conn.close()
+
+    def test_dashboard_renders_active_advance(self):
+        prime_fx_cache(self)
+
+        cl_id = self._create_credit_line()
+        today = date.today()
+        payload = self._advance_payload(cl_id)
+        payload["start_date"] = (today - timedelta(days=10)).isoformat()
+        payload["end_date"] = (today + timedelta(days=20)).isoformat()
+        payload["continuation_date"] = (today + timedelta(days=3)).isoformat()
+        fv_id = self.client.post("/advances", json=payload).get_json()["id"]
+
+        res = self.client.get("/")
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(fv_id, res.get_data(as_text=True))
+
+    def test_dashboard_cache_invalidated_by_writes(self):
+        prime_fx_cache(self)
+
+        self.assertEqual(self.client.get("/").status_code, 200)
+
+        cl_id = self._create_credit_line()
+        today = date.today()
+        payload = self._advance_payload(cl_id)
+        payload["start_date"] = (today - timedelta(days=10)).isoformat()
+        payload["end_date"] = (today + timedelta(days=20)).isoformat()
+        payload["continuation_date"] = (today + timedelta(days=3)).isoformat()
+        fv_id = self.client.post("/advances", json=payload).get_json()["id"]
+
+        self.assertIn(fv_id, self.client.get("/").get_data(as_text=True))
+
+    def test_credit_lines_page_lists_lines(self):
+        prime_fx_cache(self)
+
+        cl_id = self._create_credit_line()
+        res = self.client.get("/credit-lines")
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(cl_id, res.get_data(as_text=True))
+
+    def test_advances_page_is_keyset_paginated(self):
+        prime_fx_cache(self)
+        self.addCleanup(setattr, app_module, "ADVANCES_PAGE_SIZE", app_module.ADVANCES_PAGE_SIZE)
+        app_module.ADVANCES_PAGE_SIZE = 2
+
+        cl_id = self._create_credit_line()
+        ids = []
+        for day in ("10", "11", "12"):
+            payload = self._advance_payload(cl_id)
+            payload["start_date"] = f"2026-01-{day}"
+            ids.append(self.client.post("/advances", json=payload).get_json()["id"])
+
+        first = self.client.get("/advances").get_data(as_text=True)
+        self.assertIn("All Advances (3)", first)
+        self.assertIn(ids[2], first)
+        self.assertIn(ids[1], first)
+        self.assertNotIn(ids[0], first)
+        self.assertIn(f"before_id={ids[1]}", first)
+
+        second = self.client.get(
+            f"/advances?before_date=2026-01-11&before_id={ids[1]}"
+        ).get_data(as_text=True)
+        self.assertIn(ids[0], second)
+        self.assertNotIn(ids[1], second)
+        self.assertNotIn("Older", second)
+
+    def test_dashboard_revalidates_with_etag(self):
+        prime_fx_cache(self)
+
+        res = self.client.get("/")
+        etag = res.headers["ETag"]
+        self.assertIn("no-cache", res.headers["Cache-Control"])
+        res = self.client.get("/", headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+
+        self._create_credit_line()
+        res = self.client.get("/", headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 200)
+
+    def test_ecb_rate_is_cacheable(self):
+        prime_fx_cache(self)
+
+        res = self.client.get("/api/ecb-rate")
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(f"max-age={ecb.FX_CACHE_TTL}", res.headers["Cache-Control"])
+        res = self.client.get("/api/ecb-rate", headers={"If-None-Match": res.headers["ETag"]})
+        self.assertEqual(res.status_code, 304)
+
+    def test_export_status_after_write_reports_finished_export(self):
+        self._create_credit_line()
+        app_module.export_worker.wait()
+
+        res = self.client.get("/api/export-status")
+        self.assertEqual(res.status_code, 200)
+        body = res.get_json()
+        self.assertFalse(body["pending"])
+        self.assertIn("error", body)
+        self.assertIn("last_export", body)
+
     def test_not_found_get_endpoints(self):
         res = self.client.get("/credit-lines/CL999")
         self.assertEqual(res.status_code, 404)
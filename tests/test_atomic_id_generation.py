@@ -0,0 +1,147 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+from db_template import copy_template_db, override_db_path
+
+WORKERS = 8
+
+
+class AtomicIdGenerationTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # One set of workers for every parallel test instead of a fresh pool each
+        cls._pool = ThreadPoolExecutor(max_workers=WORKERS)
+        cls.addClassCleanup(cls._pool.shutdown)
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.db_path = os.path.join(tmpdir.name, "test_ids.db")
+
+        self.enterContext(override_db_path(self.db_path))
+        copy_template_db(self.db_path)
+
+        # Shared by the sequential tests; the parallel ones open their own
+        self.conn = db.get_db()
+        self.addCleanup(self.conn.close)
+        with db.write_tx(self.conn):
+            db.upsert_bank(self.conn, "B001", "Bank 1")
+
+    def _create_credit_line(self, conn):
+        with db.write_tx(conn):
+            return db.create_credit_line(conn, {
+                "bank_key": "B001",
+                "currency": "CHF",
+                "amount": 100_000_000,
+                "committed": "Yes",
+                "start_date": "2026-01-01",
+            })
+
+    def _create_advance(self, conn, cl_id, amount=1_000_000):
+        with db.write_tx(conn):
+            return db.create_advance(conn, {
+                "bank": "Bank 1",
+                "credit_line_id": cl_id,
+                "start_date": "2026-01-10",
+                "end_date": "2026-02-10",
+                "continuation_date": "2026-02-05",
+                "currency": "CHF",
+                "amount_original": amount,
+                "interest_amount": 1_000.0,
+            })
+
+    def _run_in_parallel(self, create):
+        start = threading.Event()
+
+        def worker(_):
+            conn = db.get_db()
+            try:
+                start.wait(5)
+                return create(conn)
+            finally:
+                conn.close()
+
+        results = self._pool.map(worker, range(WORKERS))
+        # Release every worker at once so they race for IDs
+        start.set()
+        return list(results)
+
+    def test_sequential_ids_are_formatted(self):
+        self.assertEqual(self._create_credit_line(self.conn), "CL001")
+        self.assertEqual(self._create_credit_line(self.conn), "CL002")
+        self.assertEqual(self._create_advance(self.conn, "CL001"), "FV0001")
+
+    def test_ids_without_returning_support(self):
+        # SQLite before 3.35 has no UPDATE ... RETURNING
+        self.addCleanup(setattr, db, "_SQLITE_HAS_RETURNING", db._SQLITE_HAS_RETURNING)
+        db._SQLITE_HAS_RETURNING = False
+        with db.write_tx(self.conn):
+            self.conn.execute("DELETE FROM id_sequences")
+
+        self.assertEqual(self._create_credit_line(self.conn), "CL001")
+        self.assertEqual(self._create_credit_line(self.conn), "CL002")
+
+    def test_parallel_credit_line_creates_get_unique_ids(self):
+        ids = self._run_in_parallel(self._create_credit_line)
+        self.assertEqual(sorted(ids), [f"CL{n:03d}" for n in range(1, WORKERS + 1)])
+
+    def test_parallel_advance_creates_get_unique_ids(self):
+        cl_id = self._create_credit_line(self.conn)
+
+        ids = self._run_in_parallel(lambda c: self._create_advance(c, cl_id))
+        self.assertEqual(sorted(ids), [f"FV{n:04d}" for n in range(1, WORKERS + 1)])
+
+    def test_sequence_starts_after_existing_ids(self):
+        with db.write_tx(self.conn):
+            self.conn.execute(
+                "INSERT INTO credit_lines (id, bank_key, currency, amount, committed, start_date) "
+                "VALUES ('CL041', 'B001', 'CHF', 1, 'No', '2026-01-01')"
+            )
+            self.conn.execute("DELETE FROM id_sequences")
+        # An unversioned database makes init_db run its migrations, seeding included
+        self.conn.execute("PRAGMA user_version = 0")
+        db.init_db()
+
+        self.assertEqual(
+            self.conn.execute(
+                "SELECT last_value FROM id_sequences WHERE name = 'credit_lines'"
+            ).fetchone()[0],
+            41,
+        )
+        self.assertEqual(self._create_credit_line(self.conn), "CL042")
+
+    def test_max_existing_id_ignores_malformed_ids(self):
+        with db.write_tx(self.conn):
+            for cl_id in ("CL007", "CL12x", "XCL900", "CL"):
+                self.conn.execute(
+                    "INSERT INTO credit_lines (id, bank_key, currency, amount, committed, start_date) "
+                    "VALUES (?, 'B001', 'CHF', 1, 'No', '2026-01-01')",
+                    (cl_id,),
+                )
+        self.assertEqual(db._max_existing_id_number(self.conn, "credit_lines", "CL"), 7)
+        self.assertEqual(db._max_existing_id_number(self.conn, "fixed_advances", "FV"), 0)
+
+    def test_failed_insert_does_not_consume_an_id(self):
+        cl_id = self._create_credit_line(self.conn)
+        with self.assertRaises(sqlite3.IntegrityError):
+            self._create_advance(self.conn, cl_id, amount=-1)
+        self.assertEqual(self._create_advance(self.conn, cl_id), "FV0001")
+
+    def test_bulk_import_advances_sequence_past_imported_ids(self):
+        with db.write_tx(self.conn):
+            db.clear_all_data(self.conn)
+            db.bulk_insert_banks(self.conn, [{"bank_key": "B001", "bank_name": "Bank 1"}])
+            db.bulk_insert_credit_lines(self.conn, [{
+                "id": "CL007", "bank_key": "B001", "currency": "CHF",
+                "amount": 1, "committed": "No", "start_date": "2026-01-01",
+            }])
+        self.assertEqual(self._create_credit_line(self.conn), "CL008")
+
+
+if __name__ == "__main__":
+    unittest.main()
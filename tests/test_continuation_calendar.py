@@ -1,176 +1,168 @@
+from contextlib import contextmanager
 import unittest
 from datetime import date
-from unittest.mock import patch
 
-from app import build_continuation_calendar
+import app
+from app import _calendar_cells, build_continuation_calendar
+
+
+class _FrozenDate(date):
+    """date whose today() is pinned; constructing dates still works normally."""
+
+    frozen = None
+
+    @classmethod
+    def today(cls):
+        return cls.frozen
+
+
+@contextmanager
+def frozen_date(year, month, day):
+    """Make app.date.today() return the given day inside the block."""
+    orig_date = app.date
+    _FrozenDate.frozen = date(year, month, day)
+    app.date = _FrozenDate
+    try:
+        yield
+    finally:
+        app.date = orig_date
 
 
 class ContinuationCalendarTests(unittest.TestCase):
     """Tests for build_continuation_calendar() date logic."""
 
-    @patch("app.date")
-    def test_normal_month_structure(self, mock_date):
+    def test_normal_month_structure(self):
         """March 2026 starts on Sunday (weekday=6), 31 days."""
-        mock_date.today.return_value = date(2026, 3, 15)
-        mock_date.side_effect = lambda *a, **kw: date(*a, **kw)
-
-        result = build_continuation_calendar([])
+        with frozen_date(2026, 3, 15):
+            result = build_continuation_calendar([])
 
-        self.assertEqual(result["month_label"], "March 2026")
-        # 6 leading blanks (Sun start) + 31 days = 37, padded to 42 (6 rows)
-        self.assertEqual(len(result["cells"]) % 7, 0)
-        # First real day should be day 1
-        day_cells = [c for c in result["cells"] if c["day"] != ""]
-        self.assertEqual(day_cells[0]["day"], 1)
-        self.assertEqual(day_cells[-1]["day"], 31)
+            self.assertEqual(result["month_label"], "March 2026")
+            # 6 leading blanks (Sun start) + 31 days = 37, padded to 42 (6 rows)
+            self.assertEqual(len(result["days"]) % 7, 0)
+            # First real day should be day 1
+            day_cells = [d for d in result["days"] if d != ""]
+            self.assertEqual(day_cells[0], 1)
+            self.assertEqual(day_cells[-1], 31)
 
-    @patch("app.date")
-    def test_month_starting_monday(self, mock_date):
+    def test_month_starting_monday(self):
         """June 2026 starts on Monday (weekday=0), no leading blanks."""
-        mock_date.today.return_value = date(2026, 6, 10)
-        mock_date.side_effect = lambda *a, **kw: date(*a, **kw)
-
-        result = build_continuation_calendar([])
+        with frozen_date(2026, 6, 10):
+            result = build_continuation_calendar([])
 
-        # No leading blanks — first cell should be day 1
-        self.assertEqual(result["cells"][0]["day"], 1)
-        self.assertEqual(result["month_label"], "June 2026")
+            # No leading blanks — first cell should be day 1
+            self.assertEqual(result["days"][0], 1)
+            self.assertEqual(result["month_label"], "June 2026")
 
-    @patch("app.date")
-    def test_december_year_rollover(self, mock_date):
+    def test_december_year_rollover(self):
         """December correctly calculates 31 days (next_month = Jan of next year)."""
-        mock_date.today.return_value = date(2026, 12, 5)
-        mock_date.side_effect = lambda *a, **kw: date(*a, **kw)
-
-        result = build_continuation_calendar([])
+        with frozen_date(2026, 12, 5):
+            result = build_continuation_calendar([])
 
-        self.assertEqual(result["month_label"], "December 2026")
-        day_cells = [c for c in result["cells"] if c["day"] != ""]
-        self.assertEqual(len(day_cells), 31)
+            self.assertEqual(result["month_label"], "December 2026")
+            day_cells = [d for d in result["days"] if d != ""]
+            self.assertEqual(len(day_cells), 31)
 
-    @patch("app.date")
-    def test_february_non_leap(self, mock_date):
+    def test_february_non_leap(self):
         """February 2026 (non-leap) has 28 days."""
-        mock_date.today.return_value = date(2026, 2, 14)
-        mock_date.side_effect = lambda *a, **kw: date(*a, **kw)
-
-        result = build_continuation_calendar([])
+        with frozen_date(2026, 2, 14):
+            result = build_continuation_calendar([])
 
-        day_cells = [c for c in result["cells"] if c["day"] != ""]
-        self.assertEqual(len(day_cells), 28)
+            day_cells = [d for d in result["days"] if d != ""]
+            self.assertEqual(len(day_cells), 28)
 
-    @patch("app.date")
-    def test_february_leap_year(self, mock_date):
+    def test_february_leap_year(self):
         """February 2028 (leap) has 29 days."""
-        mock_date.today.return_value = date(2028, 2, 10)
-        mock_date.side_effect = lambda *a, **kw: date(*a, **kw)
-
-        result = build_continuation_calendar([])
+        with frozen_date(2028, 2, 10):
+            result = build_continuation_calendar([])
 
-        day_cells = [c for c in result["cells"] if c["day"] != ""]
-        self.assertEqual(len(day_cells), 29)
+            day_cells = [d for d in result["days"] if d != ""]
+            self.assertEqual(len(day_cells), 29)
 
-    @patch("app.date")
-    def test_marked_dates_flagged(self, mock_date):
+    def test_marked_dates_flagged(self):
         """Continuation dates are marked in cells."""
-        mock_date.today.return_value = date(2026, 3, 15)
-        mock_date.side_effect = lambda *a, **kw: date(*a, **kw)
-
-        alerts = [
-            {"continuation_date": "2026-03-10"},
-            {"continuation_date": "2026-03-20"},
-        ]
-        result = build_continuation_calendar(alerts)
-
-        marked = [c for c in result["cells"] if c["marked"]]
-        self.assertEqual(len(marked), 2)
-        self.assertEqual({c["day"] for c in marked}, {10, 20})
-
-    @patch("app.date")
-    def test_today_flagged(self, mock_date):
+        with frozen_date(2026, 3, 15):
+            alerts = [
+                {"continuation_date": "2026-03-10"},
+                {"continuation_date": "2026-03-20"},
+            ]
+            result = build_continuation_calendar(alerts)
+
+            marked = [d for d, m in zip(result["days"], result["marked_mask"]) if m]
+            self.assertEqual(len(marked), 2)
+            self.assertEqual(set(marked), {10, 20})
+
+    def test_today_flagged(self):
         """Today's date is flagged in cells."""
-        mock_date.today.return_value = date(2026, 3, 15)
-        mock_date.side_effect = lambda *a, **kw: date(*a, **kw)
-
-        result = build_continuation_calendar([])
+        with frozen_date(2026, 3, 15):
+            result = build_continuation_calendar([])
 
-        today_cells = [c for c in result["cells"] if c["today"]]
-        self.assertEqual(len(today_cells), 1)
-        self.assertEqual(today_cells[0]["day"], 15)
+            self.assertEqual(result["days"][result["today_idx"]], 15)
 
-    @patch("app.date")
-    def test_grid_always_complete_weeks(self, mock_date):
+    def test_grid_always_complete_weeks(self):
         """Cell count is always a multiple of 7."""
         for month in range(1, 13):
-            mock_date.today.return_value = date(2026, month, 1)
-            mock_date.side_effect = lambda *a, **kw: date(*a, **kw)
-            result = build_continuation_calendar([])
-            self.assertEqual(
-                len(result["cells"]) % 7, 0,
-                f"Month {month} cells not a multiple of 7"
-            )
+            with self.subTest(month=month), frozen_date(2026, month, 1):
+                result = build_continuation_calendar([])
+                self.assertEqual(len(result["days"]) % 7, 0)
 
     # ── New: explicit year/month parameter tests ──
 
-    @patch("app.date")
-    def test_explicit_month_overrides_today(self, mock_date):
+    def test_explicit_month_overrides_today(self):
         """Passing year/month builds that month, not today's."""
-        mock_date.today.return_value = date(2026, 3, 15)
-        mock_date.side_effect = lambda *a, **kw: date(*a, **kw)
-
-        result = build_continuation_calendar([], year=2026, month=7)
+        with frozen_date(2026, 3, 15):
+            result = build_continuation_calendar([], year=2026, month=7)
 
-        self.assertEqual(result["month_label"], "July 2026")
-        self.assertEqual(result["year"], 2026)
-        self.assertEqual(result["month"], 7)
-        day_cells = [c for c in result["cells"] if c["day"] != ""]
-        self.assertEqual(len(day_cells), 31)
+            self.assertEqual(result["month_label"], "July 2026")
+            self.assertEqual(result["year"], 2026)
+            self.assertEqual(result["month"], 7)
+            day_cells = [d for d in result["days"] if d != ""]
+            self.assertEqual(len(day_cells), 31)
 
-    @patch("app.date")
-    def test_today_not_flagged_on_other_month(self, mock_date):
+    def test_today_not_flagged_on_other_month(self):
         """Today indicator should not appear when viewing a different month."""
-        mock_date.today.return_value = date(2026, 3, 15)
-        mock_date.side_effect = lambda *a, **kw: date(*a, **kw)
+        with frozen_date(2026, 3, 15):
+            result = build_continuation_calendar([], year=2026, month=4)
 
-        result = build_continuation_calendar([], year=2026, month=4)
+            self.assertIsNone(result["today_idx"])
 
-        today_cells = [c for c in result["cells"] if c["today"]]
-        self.assertEqual(len(today_cells), 0)
-
-    @patch("app.date")
-    def test_today_flagged_on_current_month_explicit(self, mock_date):
+    def test_today_flagged_on_current_month_explicit(self):
         """Today indicator appears when explicitly requesting current month."""
-        mock_date.today.return_value = date(2026, 3, 15)
-        mock_date.side_effect = lambda *a, **kw: date(*a, **kw)
-
-        result = build_continuation_calendar([], year=2026, month=3)
+        with frozen_date(2026, 3, 15):
+            result = build_continuation_calendar([], year=2026, month=3)
 
-        today_cells = [c for c in result["cells"] if c["today"]]
-        self.assertEqual(len(today_cells), 1)
-        self.assertEqual(today_cells[0]["day"], 15)
+            self.assertEqual(result["days"][result["today_idx"]], 15)
 
-    @patch("app.date")
-    def test_return_includes_year_and_month(self, mock_date):
+    def test_return_includes_year_and_month(self):
         """Return dict includes year and month keys."""
-        mock_date.today.return_value = date(2026, 5, 1)
-        mock_date.side_effect = lambda *a, **kw: date(*a, **kw)
-
-        result = build_continuation_calendar([])
+        with frozen_date(2026, 5, 1):
+            result = build_continuation_calendar([])
 
-        self.assertEqual(result["year"], 2026)
-        self.assertEqual(result["month"], 5)
+            self.assertEqual(result["year"], 2026)
+            self.assertEqual(result["month"], 5)
 
-    @patch("app.date")
-    def test_december_explicit(self, mock_date):
+    def test_december_explicit(self):
         """December with explicit params calculates correctly."""
-        mock_date.today.return_value = date(2026, 6, 1)
-        mock_date.side_effect = lambda *a, **kw: date(*a, **kw)
+        with frozen_date(2026, 6, 1):
+            result = build_continuation_calendar([], year=2026, month=12)
+
+            self.assertEqual(result["month_label"], "December 2026")
+            day_cells = [d for d in result["days"] if d != ""]
+            self.assertEqual(len(day_cells), 31)
+
+    def test_repeat_builds_hit_cache(self):
+        """Same day and same marked dates reuse the cached grid."""
+        with frozen_date(2026, 3, 15):
+            _calendar_cells.cache_clear()
+            alerts = [{"continuation_date": "2026-03-20"}]
+
+            first = build_continuation_calendar(alerts)
+            second = build_continuation_calendar(list(alerts))
 
-        result = build_continuation_calendar([], year=2026, month=12)
+            self.assertIs(first["days"], second["days"])
+            self.assertEqual(_calendar_cells.cache_info().hits, 1)
 
-        self.assertEqual(result["month_label"], "December 2026")
-        day_cells = [c for c in result["cells"] if c["day"] != ""]
-        self.assertEqual(len(day_cells), 31)
+            moved = build_continuation_calendar([{"continuation_date": "2026-03-21"}])
+            self.assertIsNot(moved["marked_mask"], first["marked_mask"])
 
 
 if __name__ == "__main__":
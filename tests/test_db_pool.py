@@ -0,0 +1,156 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import db
+from db_template import override_db_path
+
+
+class ConnectionPoolTests(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.db_path = os.path.join(tmpdir.name, "test_pool.db")
+
+        self.enterContext(override_db_path(self.db_path))
+        db.init_db()
+        self.addCleanup(db.close_pool)
+
+    def test_reader_connection_is_reused(self):
+        pool = db.get_pool()
+        with pool.reader() as first:
+            pass
+        with pool.reader() as second:
+            self.assertIs(first, second)
+
+    def test_readers_are_opened_up_front(self):
+        pool = db.get_pool()
+        self.assertEqual(pool._readers.qsize(), db.READ_POOL_SIZE)
+
+    def test_nested_readers_get_distinct_connections(self):
+        pool = db.get_pool()
+        with pool.reader() as outer, pool.reader() as inner:
+            self.assertIsNot(outer, inner)
+
+    def test_reader_is_read_only(self):
+        with db.get_pool().reader() as conn:
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute("INSERT INTO banks (bank_key, bank_name) VALUES ('B001', 'Bank')")
+
+    def test_writer_commit_visible_to_reader(self):
+        pool = db.get_pool()
+        with pool.writer() as conn:
+            with db.write_tx(conn):
+                db.upsert_bank(conn, "B001", "Bank 1")
+        with pool.reader() as conn:
+            self.assertEqual(len(db.get_banks(conn)), 1)
+
+    def test_writer_rolls_back_uncommitted_work(self):
+        pool = db.get_pool()
+        with pool.writer() as conn:
+            conn.execute("INSERT INTO banks (bank_key, bank_name) VALUES ('B001', 'Bank')")
+        with pool.reader() as conn:
+            self.assertEqual(len(db.get_banks(conn)), 0)
+
+    def test_pool_enables_wal(self):
+        with db.get_pool().reader() as conn:
+            mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, "wal")
+
+    def test_init_db_enables_wal(self):
+        conn = db.get_db()
+        try:
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        finally:
+            conn.close()
+
+    def test_new_database_uses_8k_pages(self):
+        with db.get_pool().reader() as conn:
+            self.assertEqual(conn.execute("PRAGMA page_size").fetchone()[0], 8192)
+
+    def test_init_db_skips_setup_when_schema_version_matches(self):
+        conn = db.get_db()
+        try:
+            self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], db.SCHEMA_VERSION)
+            conn.execute("DELETE FROM settings WHERE key = 'display_unit'")
+            conn.commit()
+        finally:
+            conn.close()
+
+        db.init_db()
+        conn = db.get_db()
+        try:
+            self.assertIsNone(db.get_setting(conn, "display_unit"))
+        finally:
+            conn.close()
+
+    def test_stamped_database_skips_legacy_migrations(self):
+        conn = db.get_db()
+        try:
+            conn.execute("PRAGMA user_version = 1")
+        finally:
+            conn.close()
+
+        with mock.patch.object(db, "_migrate_remove_currency_check") as migrate:
+            db.init_db()
+        migrate.assert_not_called()
+
+        conn = db.get_db()
+        try:
+            self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], db.SCHEMA_VERSION)
+        finally:
+            conn.close()
+
+    def test_active_window_queries_use_indexes(self):
+        with db.get_pool().reader() as conn:
+            plan = " ".join(
+                r[3] for r in conn.execute(
+                    "EXPLAIN QUERY PLAN " + db.SQL_ACTIVE_TOTALS, {"today": "2026-01-01"}
+                )
+            )
+        self.assertIn("idx_fa_active", plan)
+
+    def test_utilization_query_uses_indexes(self):
+        with db.get_pool().reader() as conn:
+            plan = " ".join(
+                r[3] for r in conn.execute(
+                    "EXPLAIN QUERY PLAN " + db.SQL_CL_UTILIZATION, {"today": "2026-01-01"}
+                )
+            )
+        self.assertIn("idx_cl_archived", plan)
+        self.assertIn("idx_fa_credit_line", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_closing_pool_runs_optimize(self):
+        pool = db.get_pool()
+        statements = []
+        pool._writer.set_trace_callback(statements.append)
+        db.close_pool()
+        self.assertIn("PRAGMA optimize", statements)
+
+    def test_fx_cache_keeps_latest_fetch(self):
+        with db.get_pool().writer() as conn:
+            with db.write_tx(conn):
+                db.save_fx_cache(conn, "2026-01-01", 100.0, {"CHF": 1.0, "EUR": 0.94})
+                db.save_fx_cache(conn, "2026-01-02", 200.0, {"CHF": 1.0, "EUR": 0.95})
+        with db.get_pool().reader() as conn:
+            self.assertEqual(
+                db.get_fx_cache(conn), ("2026-01-02", 200.0, {"CHF": 1.0, "EUR": 0.95})
+            )
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM fx_cache").fetchone()[0], 1)
+
+    def test_pool_follows_db_path(self):
+        pool = db.get_pool()
+        self.assertIs(db.get_pool(), pool)
+
+        other_path = self.db_path + ".other"
+        self.addCleanup(lambda: os.path.exists(other_path) and os.unlink(other_path))
+        db.DB_PATH = other_path
+        self.assertIsNot(db.get_pool(), pool)
+        self.assertEqual(db.get_pool().path, other_path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,9 @@
 from datetime import date
 import json
+import threading
+import time
 import unittest
-from unittest import mock
+import urllib.request
 
 import ecb
 from config import BASE_CURRENCY
@@ -21,9 +23,58 @@ class _FakeResponse:
         return False
 
 
+class _FakeUrlopen:
+    """Stand-in for urllib.request.urlopen that counts calls.
+
+    Each call runs ``before`` (if given), then raises ``error`` or answers
+    with ``payload``.
+    """
+
+    def __init__(self, payload=None, error=None, before=None):
+        self.payload = payload
+        self.error = error
+        self.before = before
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        if self.before is not None:
+            self.before()
+        if self.error is not None:
+            raise self.error
+        return _FakeResponse(self.payload)
+
+
+def _install_urlopen(test, fake):
+    """Route ecb's network calls to fake for the rest of the test."""
+    orig_urlopen = urllib.request.urlopen
+    test.addCleanup(setattr, urllib.request, "urlopen", orig_urlopen)
+    urllib.request.urlopen = fake
+    return fake
+
+
+def _rates_payload():
+    """ECB jsondata answer with CHF and USD rates per EUR."""
+    return json.dumps({
+        "dataSets": [{"series": {
+            "0:0:0:0:0": {"observations": {"0": [0.93]}},
+            "0:1:0:0:0": {"observations": {"0": [1.08]}},
+        }}],
+        "structure": {"dimensions": {
+            "series": [
+                {"id": "FREQ", "values": [{"id": "D"}]},
+                {"id": "CURRENCY", "values": [{"id": "CHF"}, {"id": "USD"}]},
+            ],
+            "observation": [{"values": [{"id": "2026-01-02"}]}],
+        }},
+    }).encode("utf-8")
+
+
 class EcbResilienceTests(unittest.TestCase):
     def setUp(self):
         ecb.clear_cache()
+        self.addCleanup(setattr, ecb, "_store", ecb._store)
+        ecb._store = None
 
     def tearDown(self):
         ecb.clear_cache()
@@ -33,17 +84,17 @@ class EcbResilienceTests(unittest.TestCase):
         ecb._cache["date"] = today
         ecb._cache["rates"] = {BASE_CURRENCY: 1.0, "EUR": 1.05}
 
-        with mock.patch("urllib.request.urlopen", side_effect=AssertionError("should not call network")):
-            rates, rate_date = ecb.get_fx_rates([{"code": "CHF", "ecb_available": 1}])
+        _install_urlopen(self, _FakeUrlopen(error=AssertionError("should not call network")))
+        rates, rate_date = ecb.get_fx_rates([{"code": "CHF", "ecb_available": 1}])
 
         self.assertEqual(rates["EUR"], 1.05)
         self.assertEqual(rate_date, today)
 
     def test_timeout_falls_back_to_base_rate_when_no_cache(self):
-        with mock.patch("urllib.request.urlopen", side_effect=TimeoutError("timeout")):
-            rates, rate_date = ecb.get_fx_rates(
-                [{"code": "CHF", "ecb_available": 1}, {"code": "USD", "ecb_available": 1}]
-            )
+        _install_urlopen(self, _FakeUrlopen(error=TimeoutError("timeout")))
+        rates, rate_date = ecb.get_fx_rates(
+            [{"code": "CHF", "ecb_available": 1}, {"code": "USD", "ecb_available": 1}]
+        )
 
         self.assertEqual(rates, {BASE_CURRENCY: 1.0})
         self.assertIsNone(rate_date)
@@ -53,21 +104,125 @@ class EcbResilienceTests(unittest.TestCase):
         ecb._cache["rates"] = {BASE_CURRENCY: 1.0, "EUR": 1.02}
         bad_payload = json.dumps({"unexpected": "shape"}).encode("utf-8")
 
-        with mock.patch("urllib.request.urlopen", return_value=_FakeResponse(bad_payload)):
-            rates, rate_date = ecb.get_fx_rates(
-                [{"code": "CHF", "ecb_available": 1}, {"code": "USD", "ecb_available": 1}]
-            )
+        urlopen = _install_urlopen(self, _FakeUrlopen(bad_payload))
+        rates, rate_date = ecb.get_fx_rates(
+            [{"code": "CHF", "ecb_available": 1}, {"code": "USD", "ecb_available": 1}]
+        )
+        ecb.wait_for_refresh()
 
+        self.assertEqual(urlopen.calls, 1)
         self.assertEqual(rates["EUR"], 1.02)
         self.assertEqual(rate_date, "2026-01-01")
+        self.assertEqual(ecb._cache["rates"]["EUR"], 1.02)
+
+    def test_expired_cache_is_served_while_refreshing_in_background(self):
+        ecb._cache["date"] = date.today().isoformat()
+        ecb._cache["rates"] = {BASE_CURRENCY: 1.0, "EUR": 1.05}
+        ecb._cache["expires"] = 0
+        release = threading.Event()
+        urlopen = _install_urlopen(
+            self, _FakeUrlopen(error=TimeoutError("timeout"), before=lambda: release.wait(5))
+        )
+
+        rates, _ = ecb.get_fx_rates([{"code": "CHF", "ecb_available": 1}])
+        self.assertEqual(rates["EUR"], 1.05)
+        # A second stale read while the refresh is in flight starts no new fetch
+        ecb.get_fx_rates([{"code": "CHF", "ecb_available": 1}])
+        release.set()
+        ecb.wait_for_refresh()
+
+        self.assertEqual(urlopen.calls, 1)
+
+    def test_failed_fetch_is_not_retried_immediately(self):
+        urlopen = _install_urlopen(self, _FakeUrlopen(error=TimeoutError("timeout")))
+        ecb.get_fx_rates([{"code": "USD", "ecb_available": 1}])
+        rates, rate_date = ecb.get_fx_rates([{"code": "USD", "ecb_available": 1}])
+
+        self.assertEqual(urlopen.calls, 1)
+        self.assertEqual(rates, {BASE_CURRENCY: 1.0})
+        self.assertIsNone(rate_date)
+
+    def test_prefetch_fills_cache_in_background(self):
+        release = threading.Event()
+        urlopen = _install_urlopen(
+            self, _FakeUrlopen(_rates_payload(), before=lambda: release.wait(5))
+        )
+
+        ecb.prefetch([{"code": "USD", "ecb_available": 1}])
+        # A cold read while the prefetch is in flight waits for it
+        reader = threading.Thread(
+            target=ecb.get_fx_rates, args=([{"code": "USD", "ecb_available": 1}],)
+        )
+        reader.start()
+        release.set()
+        reader.join(5)
+        ecb.wait_for_refresh()
+        ecb.prefetch([{"code": "USD", "ecb_available": 1}])
+
+        self.assertEqual(urlopen.calls, 1)
+        self.assertIn("USD", ecb._cache["rates"])
+
+    def test_cold_read_waits_for_refresh_that_has_not_started_yet(self):
+        _install_urlopen(self, _FakeUrlopen(error=AssertionError("should not call network")))
+        # The refresh has taken the lock but its thread is not running yet
+        ecb._refresh_lock.acquire()
+        results = []
+        reader = threading.Thread(
+            target=lambda: results.append(ecb.get_fx_rates([{"code": "USD", "ecb_available": 1}]))
+        )
+        reader.start()
+        today = date.today().isoformat()
+        ecb._cache.update(date=today, rates={BASE_CURRENCY: 1.0, "USD": 0.9})
+        ecb._refresh_lock.release()
+        reader.join(5)
+
+        self.assertEqual(results, [({BASE_CURRENCY: 1.0, "USD": 0.9}, today)])
+
+    def test_validate_currencies_uses_one_request(self):
+        urlopen = _install_urlopen(self, _FakeUrlopen(_rates_payload()))
+        result = ecb.validate_currencies_ecb(["chf", "USD", "XYZ", "EUR"])
+
+        self.assertEqual(urlopen.calls, 1)
+        self.assertEqual(result, {"CHF": True, "USD": True, "XYZ": False, "EUR": True})
 
     def test_validate_currency_network_error(self):
-        with mock.patch("urllib.request.urlopen", side_effect=OSError("network down")):
-            ok, msg = ecb.validate_currency_ecb("ABC")
+        _install_urlopen(self, _FakeUrlopen(error=OSError("network down")))
+        ok, msg = ecb.validate_currency_ecb("ABC")
 
         self.assertFalse(ok)
         self.assertIn("Could not verify ABC", msg)
 
 
+class EcbStoreTests(unittest.TestCase):
+    def setUp(self):
+        ecb.clear_cache()
+        self.addCleanup(ecb.clear_cache)
+        self.stored = None
+        self.saved = []
+        orig_store = ecb._store
+        self.addCleanup(setattr, ecb, "_store", orig_store)
+        ecb.set_store(lambda: self.stored, lambda *args: self.saved.append(args))
+
+    def test_stored_rates_skip_network_after_restart(self):
+        today = date.today().isoformat()
+        self.stored = (today, time.time() - 60, {BASE_CURRENCY: 1.0, "EUR": 1.05, "USD": 0.9})
+
+        _install_urlopen(self, _FakeUrlopen(error=AssertionError("should not call network")))
+        rates, rate_date = ecb.get_fx_rates([{"code": "USD", "ecb_available": 1}])
+
+        self.assertEqual(rates["EUR"], 1.05)
+        self.assertEqual(rate_date, today)
+
+    def test_stored_rates_missing_a_currency_are_refetched(self):
+        self.stored = (date.today().isoformat(), time.time(), {BASE_CURRENCY: 1.0, "EUR": 1.05})
+        urlopen = _install_urlopen(self, _FakeUrlopen(_rates_payload()))
+        rates, _ = ecb.get_fx_rates([{"code": "USD", "ecb_available": 1}])
+
+        self.assertEqual(urlopen.calls, 1)
+        self.assertIn("USD", rates)
+        self.assertEqual(len(self.saved), 1)
+        self.assertEqual(self.saved[0][2], rates)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,125 +1,106 @@
+from contextlib import ExitStack, closing
 import os
 import tempfile
 import unittest
 
+from openpyxl import load_workbook
+
 import db
+from db_template import copy_template_db, override_db_path
 import export
 from helpers import calc_days, calc_interest_rate_pa
 
 
-class ExportTests(unittest.TestCase):
-    def setUp(self):
-        self.tmpdir = tempfile.TemporaryDirectory()
-        self.addCleanup(self.tmpdir.cleanup)
-
-        # Redirect DB to temp directory
-        db_path = os.path.join(self.tmpdir.name, "test_export.db")
-        self._orig_db_path = db.DB_PATH
-        db.DB_PATH = db_path
-        self.addCleanup(setattr, db, "DB_PATH", self._orig_db_path)
-        db.init_db()
-
-        # Redirect export path to temp directory
-        export_dir = os.path.join(self.tmpdir.name, "export")
-        self._orig_export_path = export.EXPORT_PATH
-        self._orig_export_file = export.EXPORT_FILE
-        export.EXPORT_PATH = export_dir
-        export.EXPORT_FILE = os.path.join(export_dir, "tenordash.xlsx")
-        self.addCleanup(setattr, export, "EXPORT_PATH", self._orig_export_path)
-        self.addCleanup(setattr, export, "EXPORT_FILE", self._orig_export_file)
-
-        # Also update the DB setting so _resolve_export_path() uses temp dir
-        conn = db.get_db()
-        try:
-            db.set_setting(conn, "export_path", export_dir)
-        finally:
-            conn.close()
+def _use_temp_db_and_export_dir(tmpdir, enter_context):
+    """Point db and export at a fresh database and export dir under tmpdir.
+
+    Returns an open connection.  Everything is undone when the context entered
+    through enter_context (TestCase.enterContext or enterClassContext) exits.
+    """
+    stack = enter_context(ExitStack())
+    db_path = os.path.join(tmpdir, "test_export.db")
+    stack.enter_context(override_db_path(db_path))
+    copy_template_db(db_path)
+    stack.callback(db.close_pool)
+
+    export_dir = os.path.join(tmpdir, "export")
+    stack.callback(setattr, export, "EXPORT_PATH", export.EXPORT_PATH)
+    stack.callback(setattr, export, "EXPORT_FILE", export.EXPORT_FILE)
+    export.EXPORT_PATH = export_dir
+    export.EXPORT_FILE = os.path.join(export_dir, "tenordash.xlsx")
+
+    conn = stack.enter_context(closing(db.get_db()))
+    # Also update the DB setting so export_xlsx() uses the temp dir
+    with db.write_tx(conn):
+        db.set_setting(conn, "export_path", export_dir)
+    return conn
+
+
+def _seed_data(conn):
+    """Insert a bank, credit line, and advance for testing."""
+    with db.write_tx(conn):
+        conn.execute(
+            "INSERT INTO banks (bank_key, bank_name) VALUES (?, ?)",
+            ("B001", "Test Bank"),
+        )
+        conn.execute(
+            "INSERT INTO credit_lines (id, bank_key, description, currency, amount, "
+            "committed, start_date, end_date, note, archived) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            ("CL001", "B001", "Test Facility", "CHF", 100_000_000,
+             "Yes", "2026-01-01", "2027-01-01", "test note", 0),
+        )
+        conn.execute(
+            "INSERT INTO fixed_advances (id, bank, credit_line_id, start_date, end_date, "
+            "continuation_date, currency, amount_original, interest_amount) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            ("FV0001", "B001", "CL001", "2026-01-15", "2026-04-15",
+             "2026-04-10", "CHF", 50_000_000, 125_000.0),
+        )
+
+
+def _read_sheets(path):
+    """{sheet name: [row value tuples]} read through openpyxl's streaming reader."""
+    wb = load_workbook(path, read_only=True)
+    try:
+        return {name: list(wb[name].iter_rows(values_only=True)) for name in wb.sheetnames}
+    finally:
+        wb.close()
 
-        self.export_file = export.EXPORT_FILE
 
-    def _seed_data(self):
-        """Insert a bank, credit line, and advance for testing."""
-        conn = db.get_db()
-        try:
-            conn.execute(
-                "INSERT INTO banks (bank_key, bank_name) VALUES (?, ?)",
-                ("B001", "Test Bank"),
-            )
-            conn.execute(
-                "INSERT INTO credit_lines (id, bank_key, description, currency, amount, "
-                "committed, start_date, end_date, note, archived) "
-                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                ("CL001", "B001", "Test Facility", "CHF", 100_000_000,
-                 "Yes", "2026-01-01", "2027-01-01", "test note", 0),
-            )
-            conn.execute(
-                "INSERT INTO fixed_advances (id, bank, credit_line_id, start_date, end_date, "
-                "continuation_date, currency, amount_original, interest_amount) "
-                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                ("FV0001", "B001", "CL001", "2026-01-15", "2026-04-15",
-                 "2026-04-10", "CHF", 50_000_000, 125_000.0),
-            )
-            conn.commit()
-        finally:
-            conn.close()
+class ExportedWorkbookTests(unittest.TestCase):
+    """Read-only checks against a single export of the seeded data."""
 
-    def test_creates_file(self):
-        self._seed_data()
+    @classmethod
+    def setUpClass(cls):
+        tmpdir = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(tmpdir.cleanup)
+        _seed_data(_use_temp_db_and_export_dir(tmpdir.name, cls.enterClassContext))
         export.export_xlsx()
-        self.assertTrue(os.path.isfile(self.export_file))
+        cls.export_dir = export.EXPORT_PATH
+        cls.export_file = export.EXPORT_FILE
+        cls.rows = _read_sheets(cls.export_file)
 
-    def test_creates_export_directory(self):
-        self._seed_data()
-        export.export_xlsx()
-        self.assertTrue(os.path.isdir(export.EXPORT_PATH))
+    def test_creates_export_directory_and_file(self):
+        self.assertTrue(os.path.isdir(self.export_dir))
+        self.assertTrue(os.path.isfile(self.export_file))
 
     def test_sheet_names(self):
-        from openpyxl import load_workbook
-        self._seed_data()
-        export.export_xlsx()
-        wb = load_workbook(self.export_file)
-        self.assertEqual(wb.sheetnames, ["tblFV", "tblCreditLines"])
-        wb.close()
+        self.assertEqual(list(self.rows), ["tblFV", "tblCreditLines"])
 
     def test_advance_columns(self):
-        from openpyxl import load_workbook
-        self._seed_data()
-        export.export_xlsx()
-        wb = load_workbook(self.export_file)
-        ws = wb["tblFV"]
-        headers = [cell.value for cell in ws[1]]
-        self.assertEqual(headers, export.ADVANCE_COLUMNS)
-        wb.close()
+        self.assertEqual(list(self.rows["tblFV"][0]), export.ADVANCE_COLUMNS)
 
     def test_credit_line_columns(self):
-        from openpyxl import load_workbook
-        self._seed_data()
-        export.export_xlsx()
-        wb = load_workbook(self.export_file)
-        ws = wb["tblCreditLines"]
-        headers = [cell.value for cell in ws[1]]
-        self.assertEqual(headers, export.CREDIT_LINE_COLUMNS)
-        wb.close()
+        self.assertEqual(list(self.rows["tblCreditLines"][0]), export.CREDIT_LINE_COLUMNS)
 
     def test_row_counts(self):
-        from openpyxl import load_workbook
-        self._seed_data()
-        export.export_xlsx()
-        wb = load_workbook(self.export_file)
         # 1 header + 1 data row
-        self.assertEqual(wb["tblFV"].max_row, 2)
-        self.assertEqual(wb["tblCreditLines"].max_row, 2)
-        wb.close()
+        self.assertEqual(len(self.rows["tblFV"]), 2)
+        self.assertEqual(len(self.rows["tblCreditLines"]), 2)
 
     def test_calculated_fields(self):
-        from openpyxl import load_workbook
-        self._seed_data()
-        export.export_xlsx()
-        wb = load_workbook(self.export_file)
-        ws = wb["tblFV"]
-        # Row 2 is the data row
-        row = [cell.value for cell in ws[2]]
-        headers = [cell.value for cell in ws[1]]
+        headers, row = self.rows["tblFV"]
         data = dict(zip(headers, row))
 
         expected_days = calc_days("2026-01-15", "2026-04-15")
@@ -127,41 +108,101 @@ class ExportTests(unittest.TestCase):
 
         self.assertEqual(data["days"], expected_days)
         self.assertAlmostEqual(data["rate_pa"], round(expected_rate, 6), places=6)
-        wb.close()
+
+
+class ExportTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.conn = _use_temp_db_and_export_dir(self.tmpdir.name, self.enterContext)
+        self.export_file = export.EXPORT_FILE
 
     def test_empty_tables(self):
-        from openpyxl import load_workbook
         # No seed data — tables are empty
         export.export_xlsx()
         self.assertTrue(os.path.isfile(self.export_file))
-        wb = load_workbook(self.export_file)
+        rows = _read_sheets(self.export_file)
         # Only header rows
-        self.assertEqual(wb["tblFV"].max_row, 1)
-        self.assertEqual(wb["tblCreditLines"].max_row, 1)
-        wb.close()
+        self.assertEqual(len(rows["tblFV"]), 1)
+        self.assertEqual(len(rows["tblCreditLines"]), 1)
 
     def test_includes_archived_credit_lines(self):
-        from openpyxl import load_workbook
-        self._seed_data()
+        _seed_data(self.conn)
         # Add an archived credit line
-        conn = db.get_db()
-        try:
-            conn.execute(
+        with db.write_tx(self.conn):
+            self.conn.execute(
                 "INSERT INTO credit_lines (id, bank_key, description, currency, amount, "
                 "committed, start_date, end_date, note, archived) "
                 "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
                 ("CL002", "B001", "Archived Facility", "EUR", 50_000_000,
                  "No", "2025-01-01", "2025-12-31", None, 1),
             )
-            conn.commit()
-        finally:
-            conn.close()
 
         export.export_xlsx()
-        wb = load_workbook(self.export_file)
         # Header + 2 credit lines (active + archived)
-        self.assertEqual(wb["tblCreditLines"].max_row, 3)
-        wb.close()
+        self.assertEqual(len(_read_sheets(self.export_file)["tblCreditLines"]), 3)
+
+    def test_text_is_escaped_and_blanks_left_empty(self):
+        _seed_data(self.conn)
+        with db.write_tx(self.conn):
+            self.conn.execute(
+                "UPDATE credit_lines SET description = ?, note = NULL WHERE id = 'CL001'",
+                ("R&D <new>\x01 ",),
+            )
+
+        export.export_xlsx()
+        row = dict(zip(export.CREDIT_LINE_COLUMNS, _read_sheets(self.export_file)["tblCreditLines"][1]))
+        self.assertEqual(row["description"], "R&D <new> ")
+        self.assertIsNone(row["note"])
+        self.assertEqual(row["amount"], 100_000_000)
+
+    def test_worker_exports_in_background(self):
+        _seed_data(self.conn)
+        worker = export.ExportWorker(debounce=0)
+        worker.submit()
+        worker.wait()
+        self.assertTrue(os.path.isfile(self.export_file))
+        self.assertIsNone(worker.status()["error"])
+        self.assertIsNotNone(worker.status()["last_export"])
+
+    def test_worker_records_failure(self):
+        # A regular file where the export directory should be makes the export fail
+        blocker = os.path.join(self.tmpdir.name, "not-a-dir")
+        with open(blocker, "w") as f:
+            f.write("x")
+        worker = export.ExportWorker(debounce=0)
+        with self.assertLogs("export", level="ERROR"):
+            worker.submit(export_path=blocker)
+            worker.wait()
+        self.assertIsNotNone(worker.status()["error"])
+        self.assertFalse(worker.status()["pending"])
+
+
+class WriteXlsxTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, "out.xlsx")
+
+    def test_column_letters_past_z(self):
+        self.assertEqual(
+            [export._column_letter(i) for i in (0, 25, 26, 51, 52, 701, 702)],
+            ["A", "Z", "AA", "AZ", "BA", "ZZ", "AAA"],
+        )
+
+    def test_wide_sheet_round_trips(self):
+        header = [f"col{i}" for i in range(30)]
+        row = list(range(30))
+        export._write_xlsx(self.path, [("wide", header, [row])])
+        self.assertEqual(_read_sheets(self.path)["wide"], [tuple(header), tuple(row)])
+
+    def test_bool_and_non_finite_written_as_text(self):
+        values = [True, False, float("inf"), float("-inf"), float("nan"), 1.5]
+        export._write_xlsx(self.path, [("s", ["a", "b", "c", "d", "e", "f"], [values])])
+        self.assertEqual(
+            _read_sheets(self.path)["s"][1],
+            ("True", "False", "inf", "-inf", "nan", 1.5),
+        )
 
 
 if __name__ == "__main__":
@@ -1,6 +1,10 @@
 from datetime import date, timedelta
+import os
+import tempfile
 import unittest
 
+import db
+from db_template import copy_template_db, override_db_path
 import helpers
 
 
@@ -25,6 +29,11 @@ class HelpersBusinessRuleTests(unittest.TestCase):
             "2026-01-07",
         )
 
+    def test_continuation_date_for_weekend_and_midweek_end_dates(self):
+        self.assertEqual(helpers.suggest_continuation_date("2026-01-10"), "2026-01-07")  # Sat
+        self.assertEqual(helpers.suggest_continuation_date("2026-01-11"), "2026-01-07")  # Sun
+        self.assertEqual(helpers.suggest_continuation_date("2026-01-15"), "2026-01-12")  # Thu
+
     def test_is_currently_active_boundaries(self):
         today = date.today()
         self.assertTrue(
@@ -46,6 +55,54 @@ class HelpersBusinessRuleTests(unittest.TestCase):
             )
         )
 
+    def test_is_currently_active_uses_given_day(self):
+        day = date(2026, 3, 1)
+        self.assertTrue(helpers.is_currently_active("2026-03-01", "2026-03-02", today=day))
+        self.assertFalse(helpers.is_currently_active("2026-02-01", "2026-03-01", today=day))
+
+
+class AdvanceProjectionTests(unittest.TestCase):
+    """db computes enrich_advance()'s derived fields in SQL; they must agree."""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.enterContext(override_db_path(os.path.join(tmpdir.name, "test_projection.db")))
+        copy_template_db(db.DB_PATH)
+
+    def test_sql_derived_fields_match_enrich_advance(self):
+        today = date.today()
+        advances = [
+            (today - timedelta(days=5), today + timedelta(days=25), 10_000.0, 1_000_000),
+            (date(2026, 1, 10), date(2026, 2, 10), 196_527.78, 50_000_000),
+            (today + timedelta(days=1), today + timedelta(days=92), 1_234.56, 7_654_321),
+        ]
+        conn = db.get_db()
+        try:
+            with db.write_tx(conn):
+                db.upsert_bank(conn, "B001", "Bank 1")
+                cl_id = db.create_credit_line(conn, {
+                    "bank_key": "B001", "currency": "CHF", "amount": 100_000_000,
+                    "committed": "Yes", "start_date": "2026-01-01",
+                })
+                for start, end, interest, amount in advances:
+                    db.create_advance(conn, {
+                        "bank": "Bank 1", "credit_line_id": cl_id,
+                        "start_date": start.isoformat(), "end_date": end.isoformat(),
+                        "continuation_date": end.isoformat(), "currency": "CHF",
+                        "amount_original": amount, "interest_amount": interest,
+                    })
+            rows = db.get_advances(conn, today=today)
+        finally:
+            conn.close()
+
+        self.assertEqual(len(rows), len(advances))
+        for row in rows:
+            expected = helpers.enrich_advance(row, today=today)
+            self.assertEqual(row["days"], expected["days"])
+            self.assertEqual(row["rate_pa"], expected["rate_pa"])
+            self.assertEqual(bool(row["active"]), expected["active"])
+
 
 if __name__ == "__main__":
     unittest.main()
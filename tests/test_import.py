@@ -1,8 +1,15 @@
+import io
 import os
+import sqlite3
 import tempfile
 import unittest
 
+from openpyxl import Workbook
+
 import db
+from db_template import (
+    copy_template_db, override_db_path, prime_fx_cache, run_exports_immediately,
+)
 
 
 class BulkDbTests(unittest.TestCase):
@@ -10,107 +17,124 @@ class BulkDbTests(unittest.TestCase):
         tmpdir = tempfile.TemporaryDirectory()
         self.addCleanup(tmpdir.cleanup)
         db_path = os.path.join(tmpdir.name, "test_import.db")
-        self._orig_db_path = db.DB_PATH
-        db.DB_PATH = db_path
-        self.addCleanup(setattr, db, "DB_PATH", self._orig_db_path)
-        db.init_db()
+        self.enterContext(override_db_path(db_path))
+        copy_template_db(db_path)
+        self.conn = db.get_db()
+        self.addCleanup(self.conn.close)
 
     def test_bulk_insert_banks(self):
-        conn = db.get_db()
-        try:
-            rows = [
-                {"bank_key": "B001", "bank_name": "Alpha Bank"},
-                {"bank_key": "B002", "bank_name": "Beta Bank"},
-            ]
-            result = db.bulk_insert_banks(conn, rows)
-            self.assertEqual(result["added"], 2)
-            self.assertEqual(result["skipped"], 0)
-            banks = db.get_banks(conn)
-            self.assertEqual(len(banks), 2)
-        finally:
-            conn.close()
+        rows = [
+            {"bank_key": "B001", "bank_name": "Alpha Bank"},
+            {"bank_key": "B002", "bank_name": "Beta Bank"},
+        ]
+        with db.write_tx(self.conn):
+            result = db.bulk_insert_banks(self.conn, rows)
+        self.assertEqual(result["added"], 2)
+        self.assertEqual(result["skipped"], 0)
+        banks = db.get_banks(self.conn)
+        self.assertEqual(len(banks), 2)
 
     def test_bulk_insert_banks_skips_duplicates(self):
-        conn = db.get_db()
-        try:
-            db.upsert_bank(conn, "B001", "Existing Bank")
-            rows = [
-                {"bank_key": "B001", "bank_name": "Alpha Bank"},
-                {"bank_key": "B002", "bank_name": "Beta Bank"},
-            ]
-            result = db.bulk_insert_banks(conn, rows)
-            self.assertEqual(result["added"], 1)
-            self.assertEqual(result["skipped"], 1)
-        finally:
-            conn.close()
+        rows = [
+            {"bank_key": "B001", "bank_name": "Alpha Bank"},
+            {"bank_key": "B002", "bank_name": "Beta Bank"},
+        ]
+        with db.write_tx(self.conn):
+            db.upsert_bank(self.conn, "B001", "Existing Bank")
+            result = db.bulk_insert_banks(self.conn, rows)
+        self.assertEqual(result["added"], 1)
+        self.assertEqual(result["skipped"], 1)
+
+    def test_bulk_insert_banks_rejects_missing_name(self):
+        with self.assertRaises(sqlite3.IntegrityError):
+            with db.write_tx(self.conn):
+                db.bulk_insert_banks(self.conn, [{"bank_key": "B001", "bank_name": None}])
+
+    def test_bulk_insert_requires_open_transaction(self):
+        with self.assertRaises(RuntimeError):
+            db.bulk_insert_credit_lines(self.conn, [])
 
     def test_bulk_insert_credit_lines(self):
-        conn = db.get_db()
-        try:
-            conn.execute("INSERT INTO banks (bank_key, bank_name) VALUES (?, ?)", ("B001", "Bank"))
-            conn.commit()
-            rows = [
-                {"id": "CL001", "bank_key": "B001", "description": "Facility A",
-                 "currency": "CHF", "amount": 100_000_000, "committed": "Yes",
-                 "start_date": "2026-01-01", "end_date": None, "note": None},
-            ]
-            result = db.bulk_insert_credit_lines(conn, rows)
-            self.assertEqual(result["added"], 1)
-            self.assertEqual(result["errors"], 0)
-        finally:
-            conn.close()
+        with db.write_tx(self.conn):
+            self.conn.execute("INSERT INTO banks (bank_key, bank_name) VALUES (?, ?)", ("B001", "Bank"))
+        rows = [
+            {"id": "CL001", "bank_key": "B001", "description": "Facility A",
+             "currency": "CHF", "amount": 100_000_000, "committed": "Yes",
+             "start_date": "2026-01-01", "end_date": None, "note": None},
+        ]
+        with db.write_tx(self.conn):
+            result = db.bulk_insert_credit_lines(self.conn, rows)
+        self.assertEqual(result["added"], 1)
+        self.assertEqual(result["errors"], 0)
 
     def test_bulk_insert_advances(self):
-        conn = db.get_db()
-        try:
-            conn.execute("INSERT INTO banks (bank_key, bank_name) VALUES (?, ?)", ("B001", "Bank"))
-            conn.execute(
+        with db.write_tx(self.conn):
+            self.conn.execute("INSERT INTO banks (bank_key, bank_name) VALUES (?, ?)", ("B001", "Bank"))
+            self.conn.execute(
                 "INSERT INTO credit_lines (id, bank_key, description, currency, amount, "
                 "committed, start_date, end_date, note, archived) "
                 "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
                 ("CL001", "B001", "Facility", "CHF", 100_000_000,
                  "Yes", "2026-01-01", None, None, 0),
             )
-            conn.commit()
-            rows = [
-                {"id": "FV0001", "bank": "Bank", "credit_line_id": "CL001",
-                 "start_date": "2026-01-10", "end_date": "2026-02-10",
-                 "continuation_date": "2026-02-05", "currency": "CHF",
-                 "amount_original": 50_000_000, "interest_amount": 125_000.0},
-            ]
-            result = db.bulk_insert_advances(conn, rows)
-            self.assertEqual(result["added"], 1)
-            self.assertEqual(result["errors"], 0)
-        finally:
-            conn.close()
+        rows = [
+            {"id": "FV0001", "bank": "Bank", "credit_line_id": "CL001",
+             "start_date": "2026-01-10", "end_date": "2026-02-10",
+             "continuation_date": "2026-02-05", "currency": "CHF",
+             "amount_original": 50_000_000, "interest_amount": 125_000.0},
+        ]
+        with db.write_tx(self.conn):
+            result = db.bulk_insert_advances(self.conn, rows)
+        self.assertEqual(result["added"], 1)
+        self.assertEqual(result["errors"], 0)
+
+    def test_bulk_insert_advances_keeps_valid_rows_when_one_fails(self):
+        with db.write_tx(self.conn):
+            self.conn.execute("INSERT INTO banks (bank_key, bank_name) VALUES (?, ?)", ("B001", "Bank"))
+            self.conn.execute(
+                "INSERT INTO credit_lines (id, bank_key, description, currency, amount, "
+                "committed, start_date, end_date, note, archived) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                ("CL001", "B001", "Facility", "CHF", 100_000_000,
+                 "Yes", "2026-01-01", None, None, 0),
+            )
+        good = {"id": "FV0001", "bank": "Bank", "credit_line_id": "CL001",
+                "start_date": "2026-01-10", "end_date": "2026-02-10",
+                "continuation_date": "2026-02-05", "currency": "CHF",
+                "amount_original": 50_000_000, "interest_amount": 125_000.0}
+        unknown_line = dict(good, id="FV0002", credit_line_id="CL999")
+        missing_field = {"id": "FV0003"}
+        with db.write_tx(self.conn):
+            result = db.bulk_insert_advances(self.conn, [good, unknown_line, missing_field])
+        self.assertEqual(result["added"], 1)
+        self.assertEqual(result["errors"], 2)
+        ids = [r["id"] for r in self.conn.execute("SELECT id FROM fixed_advances")]
+        self.assertEqual(ids, ["FV0001"])
 
     def test_clear_all_data(self):
-        conn = db.get_db()
-        try:
-            conn.execute("INSERT INTO banks (bank_key, bank_name) VALUES (?, ?)", ("B001", "Bank"))
-            conn.execute(
+        with db.write_tx(self.conn):
+            self.conn.execute("INSERT INTO banks (bank_key, bank_name) VALUES (?, ?)", ("B001", "Bank"))
+            self.conn.execute(
                 "INSERT INTO credit_lines (id, bank_key, description, currency, amount, "
                 "committed, start_date, end_date, note, archived) "
                 "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
                 ("CL001", "B001", "Facility", "CHF", 100_000_000,
                  "Yes", "2026-01-01", None, None, 0),
             )
-            conn.execute(
+            self.conn.execute(
                 "INSERT INTO fixed_advances (id, bank, credit_line_id, start_date, end_date, "
                 "continuation_date, currency, amount_original, interest_amount) "
                 "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
                 ("FV0001", "Bank", "CL001", "2026-01-10", "2026-02-10",
                  "2026-02-05", "CHF", 50_000_000, 125_000.0),
             )
-            conn.commit()
 
-            db.clear_all_data(conn)
+        with db.write_tx(self.conn):
+            db.clear_all_data(self.conn)
 
-            self.assertEqual(conn.execute("SELECT COUNT(*) FROM fixed_advances").fetchone()[0], 0)
-            self.assertEqual(conn.execute("SELECT COUNT(*) FROM credit_lines").fetchone()[0], 0)
-            self.assertEqual(conn.execute("SELECT COUNT(*) FROM banks").fetchone()[0], 0)
-        finally:
-            conn.close()
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM fixed_advances").fetchone()[0], 0)
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM credit_lines").fetchone()[0], 0)
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM banks").fetchone()[0], 0)
 
 
 import import_utils
@@ -128,14 +152,19 @@ class ParseExcelTests(unittest.TestCase):
 
     SAMPLE_FILE = _SAMPLE_FILE
 
+    @classmethod
+    def setUpClass(cls):
+        # Parsing is deterministic; every test reads the same result
+        cls.parsed = import_utils.parse_excel(cls.SAMPLE_FILE)
+
     def test_parse_returns_three_entity_types(self):
-        result = import_utils.parse_excel(self.SAMPLE_FILE)
+        result = self.parsed
         self.assertIn("banks", result)
         self.assertIn("credit_lines", result)
         self.assertIn("advances", result)
 
     def test_credit_lines_parsed(self):
-        result = import_utils.parse_excel(self.SAMPLE_FILE)
+        result = self.parsed
         cl = result["credit_lines"]
         self.assertGreater(len(cl["rows"]), 0)
         first = cl["rows"][0]
@@ -145,7 +174,7 @@ class ParseExcelTests(unittest.TestCase):
         self.assertIn("amount", first)
 
     def test_advances_parsed(self):
-        result = import_utils.parse_excel(self.SAMPLE_FILE)
+        result = self.parsed
         adv = result["advances"]
         self.assertGreater(len(adv["rows"]), 0)
         first = adv["rows"][0]
@@ -155,7 +184,7 @@ class ParseExcelTests(unittest.TestCase):
         self.assertIn("amount_original", first)
 
     def test_banks_extracted(self):
-        result = import_utils.parse_excel(self.SAMPLE_FILE)
+        result = self.parsed
         banks = result["banks"]
         self.assertGreater(len(banks["rows"]), 0)
         first = banks["rows"][0]
@@ -163,49 +192,80 @@ class ParseExcelTests(unittest.TestCase):
         self.assertIn("bank_name", first)
 
     def test_dates_are_iso_strings(self):
-        result = import_utils.parse_excel(self.SAMPLE_FILE)
+        result = self.parsed
         first_cl = result["credit_lines"]["rows"][0]
         # Should be ISO format like "2024-01-01"
         self.assertRegex(first_cl["start_date"], r"^\d{4}-\d{2}-\d{2}$")
 
     def test_amounts_are_numeric(self):
-        result = import_utils.parse_excel(self.SAMPLE_FILE)
+        result = self.parsed
         first_cl = result["credit_lines"]["rows"][0]
         self.assertIsInstance(first_cl["amount"], (int, float))
 
 
+class ParseUnknownHeadersTests(unittest.TestCase):
+    def test_rows_under_unknown_headers_are_reported(self):
+        wb = Workbook()
+        ws = wb.active
+        ws.title = "Credit Lines"
+        ws.append([])
+        ws.append([])
+        ws.append([])
+        ws.append(["Renamed ID", "Renamed Bank"])
+        ws.append(["CL001", "B001"])
+        ws.append(["CL002", "B002"])
+        buf = io.BytesIO()
+        wb.save(buf)
+        buf.seek(0)
+
+        result = import_utils.parse_excel(buf)
+        cl = result["credit_lines"]
+        self.assertEqual(cl["rows"], [])
+        self.assertEqual([e["row"] for e in cl["errors"]], [5, 6])
+        self.assertTrue(all(
+            any("Missing required field" in m for m in e["messages"]) for e in cl["errors"]
+        ))
+
+
+_VALID_CL = {"id": "CL001", "bank_key": "B001", "currency": "CHF",
+             "amount": 100_000_000, "committed": "Yes", "start_date": "2026-01-01"}
+_VALID_ADV = {"id": "FV0001", "bank": "Bank", "credit_line_id": "CL001",
+              "start_date": "2026-01-10", "end_date": "2026-02-10",
+              "continuation_date": "2026-02-05", "currency": "CHF",
+              "amount_original": 50_000_000, "interest_amount": 125_000.0}
+
+
 class ValidationTests(unittest.TestCase):
-    def test_validate_credit_line_missing_required_field(self):
-        row = {"id": "CL001", "bank_key": "B001", "currency": "CHF"}
-        errors = import_utils.validate_credit_line(row)
-        self.assertTrue(len(errors) > 0)
-
-    def test_validate_credit_line_valid(self):
-        row = {"id": "CL001", "bank_key": "B001", "currency": "CHF",
-               "amount": 100_000_000, "committed": "Yes", "start_date": "2026-01-01"}
-        errors = import_utils.validate_credit_line(row)
-        self.assertEqual(len(errors), 0)
-
-    def test_validate_advance_missing_required_field(self):
-        row = {"id": "FV0001", "bank": "Bank", "credit_line_id": "CL001"}
-        errors = import_utils.validate_advance(row)
-        self.assertTrue(len(errors) > 0)
-
-    def test_validate_advance_valid(self):
-        row = {"id": "FV0001", "bank": "Bank", "credit_line_id": "CL001",
-               "start_date": "2026-01-10", "end_date": "2026-02-10",
-               "continuation_date": "2026-02-05", "currency": "CHF",
-               "amount_original": 50_000_000, "interest_amount": 125_000.0}
-        errors = import_utils.validate_advance(row)
-        self.assertEqual(len(errors), 0)
-
-    def test_validate_advance_bad_date_order(self):
-        row = {"id": "FV0001", "bank": "Bank", "credit_line_id": "CL001",
-               "start_date": "2026-02-10", "end_date": "2026-01-10",
-               "continuation_date": "2026-01-07", "currency": "CHF",
-               "amount_original": 50_000_000, "interest_amount": 125_000.0}
-        errors = import_utils.validate_advance(row)
-        self.assertTrue(any("end_date" in e for e in errors))
+    # (label, row, substring some error must contain; None when the row is valid)
+    CREDIT_LINE_CASES = [
+        ("valid", _VALID_CL, None),
+        ("missing required field", {"id": "CL001", "bank_key": "B001", "currency": "CHF"},
+         "Missing required field"),
+    ]
+    ADVANCE_CASES = [
+        ("valid", _VALID_ADV, None),
+        ("missing required field", {"id": "FV0001", "bank": "Bank", "credit_line_id": "CL001"},
+         "Missing required field"),
+        ("bad date order",
+         {**_VALID_ADV, "start_date": "2026-02-10", "end_date": "2026-01-10",
+          "continuation_date": "2026-01-07"},
+         "end_date"),
+    ]
+
+    def _check_cases(self, validate, cases):
+        for label, row, expected in cases:
+            with self.subTest(label):
+                errors = validate(row)
+                if expected is None:
+                    self.assertEqual(errors, [])
+                else:
+                    self.assertTrue(any(expected in e for e in errors), errors)
+
+    def test_validate_credit_line(self):
+        self._check_cases(import_utils.validate_credit_line, self.CREDIT_LINE_CASES)
+
+    def test_validate_advance(self):
+        self._check_cases(import_utils.validate_advance, self.ADVANCE_CASES)
 
 
 import importlib.util
@@ -216,35 +276,58 @@ else:
     app_module = None
 
 
+def _parsed_workbook():
+    """What parse_excel returns for a small, valid workbook."""
+    return {
+        "banks": {"rows": [{"bank_key": "B001", "bank_name": "Bank"}], "errors": []},
+        "credit_lines": {"rows": [{
+            "id": "CL001", "bank_key": "B001", "description": "Facility",
+            "currency": "CHF", "amount": 100_000_000, "committed": "Yes",
+            "start_date": "2026-01-01", "end_date": None, "note": None,
+        }], "errors": []},
+        "advances": {"rows": [dict(_VALID_ADV)], "errors": []},
+    }
+
+
 @unittest.skipUnless(app_module is not None, "flask not installed")
-@unittest.skipUnless(os.path.exists(_SAMPLE_FILE), "sample Excel file not available")
 class ImportApiTests(unittest.TestCase):
+    """Upload routes; ParseExcelTests covers the parser, so it is stubbed here."""
+
+    @classmethod
+    def setUpClass(cls):
+        config = app_module.app.config
+        cls.addClassCleanup(config.__setitem__, "TESTING", config.get("TESTING"))
+        cls.addClassCleanup(
+            config.__setitem__, "PROPAGATE_EXCEPTIONS", config.get("PROPAGATE_EXCEPTIONS")
+        )
+        config["TESTING"] = True
+        config["PROPAGATE_EXCEPTIONS"] = False
+        cls.client = app_module.app.test_client()
+
     def setUp(self):
         tmpdir = tempfile.TemporaryDirectory()
         self.addCleanup(tmpdir.cleanup)
         db_path = os.path.join(tmpdir.name, "test_import_api.db")
-        self._orig_db_path = db.DB_PATH
-        db.DB_PATH = db_path
-        self.addCleanup(setattr, db, "DB_PATH", self._orig_db_path)
-        db.init_db()
+        self.enterContext(override_db_path(db_path))
+        copy_template_db(db_path)
+        self.addCleanup(db.close_pool)
 
-        app_module.app.config["TESTING"] = True
-        app_module.app.config["PROPAGATE_EXCEPTIONS"] = False
-        self.client = app_module.app.test_client()
+        run_exports_immediately(self, app_module.export_worker)
 
-        self.sample_file = _SAMPLE_FILE
+        self.addCleanup(setattr, import_utils, "parse_excel", import_utils.parse_excel)
+        import_utils.parse_excel = lambda path: _parsed_workbook()
+        prime_fx_cache(self)
 
     def test_import_page_loads(self):
         res = self.client.get("/import")
         self.assertEqual(res.status_code, 200)
 
     def test_preview_with_valid_file(self):
-        with open(self.sample_file, "rb") as f:
-            res = self.client.post(
-                "/api/import/preview",
-                data={"file": (f, "test.xlsx")},
-                content_type="multipart/form-data",
-            )
+        res = self.client.post(
+            "/api/import/preview",
+            data={"file": (io.BytesIO(), "test.xlsx")},
+            content_type="multipart/form-data",
+        )
         self.assertEqual(res.status_code, 200)
         body = res.get_json()
         self.assertIn("banks", body)
@@ -257,12 +340,11 @@ class ImportApiTests(unittest.TestCase):
         self.assertEqual(res.status_code, 400)
 
     def test_execute_append_mode(self):
-        with open(self.sample_file, "rb") as f:
-            res = self.client.post(
-                "/api/import/execute",
-                data={"file": (f, "test.xlsx"), "mode": "append"},
-                content_type="multipart/form-data",
-            )
+        res = self.client.post(
+            "/api/import/execute",
+            data={"file": (io.BytesIO(), "test.xlsx"), "mode": "append"},
+            content_type="multipart/form-data",
+        )
         self.assertEqual(res.status_code, 200)
         body = res.get_json()
         self.assertTrue(body["ok"])
@@ -279,12 +361,11 @@ class ImportApiTests(unittest.TestCase):
         finally:
             conn.close()
 
-        with open(self.sample_file, "rb") as f:
-            res = self.client.post(
-                "/api/import/execute",
-                data={"file": (f, "test.xlsx"), "mode": "overwrite"},
-                content_type="multipart/form-data",
-            )
+        res = self.client.post(
+            "/api/import/execute",
+            data={"file": (io.BytesIO(), "test.xlsx"), "mode": "overwrite"},
+            content_type="multipart/form-data",
+        )
         self.assertEqual(res.status_code, 200)
         body = res.get_json()
         self.assertTrue(body["ok"])
@@ -292,7 +373,7 @@ class ImportApiTests(unittest.TestCase):
         # Old bank should be gone
         conn = db.get_db()
         try:
-            old = conn.execute("SELECT * FROM banks WHERE bank_key = 'BXXX'").fetchone()
+            old = conn.execute("SELECT 1 FROM banks WHERE bank_key = 'BXXX'").fetchone()
             self.assertIsNone(old)
         finally:
             conn.close()
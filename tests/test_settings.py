@@ -1,9 +1,13 @@
+from datetime import date
 import os
+import sqlite3
 import tempfile
 import unittest
 import importlib.util
+from unittest import mock
 
 import db
+from db_template import copy_template_db, override_db_path, run_exports_immediately
 import helpers
 
 if importlib.util.find_spec("flask") is not None:
@@ -20,10 +24,8 @@ class SettingsDbTests(unittest.TestCase):
         self.addCleanup(self.tmpdir.cleanup)
         db_path = os.path.join(self.tmpdir.name, "test_settings.db")
 
-        self._orig_db_path = db.DB_PATH
-        self.addCleanup(setattr, db, "DB_PATH", self._orig_db_path)
-        db.DB_PATH = db_path
-        db.init_db()
+        self.enterContext(override_db_path(db_path))
+        copy_template_db(db_path)
 
     def test_get_setting_returns_default_when_missing(self):
         conn = db.get_db()
@@ -77,7 +79,8 @@ class SettingsDbTests(unittest.TestCase):
         """Calling init_db again should not overwrite changed settings."""
         conn = db.get_db()
         try:
-            db.set_setting(conn, "display_unit", "full")
+            with db.write_tx(conn):
+                db.set_setting(conn, "display_unit", "full")
         finally:
             conn.close()
 
@@ -92,6 +95,28 @@ class SettingsDbTests(unittest.TestCase):
             conn.close()
 
 
+class CurrencyColorTests(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.enterContext(override_db_path(os.path.join(tmpdir.name, "test_colors.db")))
+        copy_template_db(db.DB_PATH)
+
+    def test_colors_fill_palette_gaps_then_cycle(self):
+        conn = db.get_db()
+        try:
+            used = {r["css_color"] for r in db.get_currencies(conn)}
+            expected = next(c for c in db.COLOR_PALETTE if c not in used)
+            self.assertEqual(db.assign_currency_color(conn), expected)
+
+            with db.write_tx(conn):
+                for i in range(len(db.COLOR_PALETTE)):
+                    db.add_currency(conn, "X" + chr(65 + i) * 2)
+            self.assertEqual(db.assign_currency_color(conn), db.COLOR_PALETTE[0])
+        finally:
+            conn.close()
+
+
 class FormatThousandsTests(unittest.TestCase):
     def test_format_millions(self):
         self.assertEqual(helpers.format_amount_thousands(80_000_000), "80,000K")
@@ -103,25 +128,43 @@ class FormatThousandsTests(unittest.TestCase):
         self.assertEqual(helpers.format_amount_thousands(500), "0K")
 
 
+class FormatForUnitTests(unittest.TestCase):
+    def test_millions(self):
+        self.assertEqual(helpers.format_amount_for_unit(80_000_000, "millions"), "80M")
+
+    def test_thousands(self):
+        self.assertEqual(helpers.format_amount_for_unit(80_000_000, "thousands"), "80,000K")
+
+    def test_full(self):
+        self.assertEqual(helpers.format_amount_for_unit(80_000_000, "full"), "80,000,000")
+
+
 @unittest.skipUnless(app_module is not None, "flask is not installed")
 class SettingsApiTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        config = app_module.app.config
+        cls.addClassCleanup(config.__setitem__, "TESTING", config.get("TESTING"))
+        cls.addClassCleanup(
+            config.__setitem__, "PROPAGATE_EXCEPTIONS", config.get("PROPAGATE_EXCEPTIONS")
+        )
+        config["TESTING"] = True
+        config["PROPAGATE_EXCEPTIONS"] = False
+        cls.client = app_module.app.test_client()
+
     def setUp(self):
         self.tmpdir = tempfile.TemporaryDirectory()
         self.addCleanup(self.tmpdir.cleanup)
         db_path = os.path.join(self.tmpdir.name, "test_api.db")
 
-        self._orig_db_path = db.DB_PATH
-        self.addCleanup(setattr, db, "DB_PATH", self._orig_db_path)
-        db.DB_PATH = db_path
-        db.init_db()
+        self.enterContext(override_db_path(db_path))
+        copy_template_db(db_path)
+        self.addCleanup(db.close_pool)
 
-        orig_testing = app_module.app.config.get("TESTING")
-        orig_propagate = app_module.app.config.get("PROPAGATE_EXCEPTIONS")
-        self.addCleanup(app_module.app.config.__setitem__, "TESTING", orig_testing)
-        self.addCleanup(app_module.app.config.__setitem__, "PROPAGATE_EXCEPTIONS", orig_propagate)
-        app_module.app.config["TESTING"] = True
-        app_module.app.config["PROPAGATE_EXCEPTIONS"] = False
-        self.client = app_module.app.test_client()
+        run_exports_immediately(self, app_module.export_worker)
+
+        self.addCleanup(setattr, app_module, "_last_good_export_path", app_module._last_good_export_path)
+        app_module._last_good_export_path = None
 
     def test_get_settings_returns_defaults(self):
         res = self.client.get("/api/settings")
@@ -132,18 +175,27 @@ class SettingsApiTests(unittest.TestCase):
 
     def test_put_valid_display_unit(self):
         for unit in ("full", "thousands", "millions"):
-            res = self.client.put("/api/settings", json={"key": "display_unit", "value": unit})
-            self.assertEqual(res.status_code, 200)
-            self.assertTrue(res.get_json()["ok"])
+            with self.subTest(unit=unit):
+                res = self.client.put("/api/settings", json={"key": "display_unit", "value": unit})
+                self.assertEqual(res.status_code, 200)
+                self.assertTrue(res.get_json()["ok"])
 
-        # Verify it stuck
-        res = self.client.get("/api/settings")
-        self.assertEqual(res.get_json()["display_unit"], "millions")
+                # Verify it stuck
+                res = self.client.get("/api/settings")
+                self.assertEqual(res.get_json()["display_unit"], unit)
 
     def test_put_invalid_display_unit(self):
         res = self.client.put("/api/settings", json={"key": "display_unit", "value": "billions"})
         self.assertEqual(res.status_code, 400)
         self.assertFalse(res.get_json()["ok"])
+        self.assertIn("display_unit must be one of", res.get_json()["error"])
+
+    def test_settings_cache_refreshes_after_write(self):
+        settings = app_module.get_settings_cached()
+        self.assertIs(app_module.get_settings_cached(), settings)
+
+        self.client.put("/api/settings", json={"key": "display_unit", "value": "full"})
+        self.assertEqual(app_module.get_settings_cached()["display_unit"], "full")
 
     def test_put_valid_export_path(self):
         path = self.tmpdir.name
@@ -151,20 +203,19 @@ class SettingsApiTests(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(res.get_json()["ok"])
 
-    def test_put_nonexistent_export_path(self):
-        res = self.client.put("/api/settings", json={"key": "export_path", "value": "/nonexistent/path/xyz"})
-        self.assertEqual(res.status_code, 400)
-        self.assertIn("does not exist", res.get_json()["error"])
+    def test_resaving_export_path_skips_filesystem_checks(self):
+        path = self.tmpdir.name
+        self.client.put("/api/settings", json={"key": "export_path", "value": path})
 
-    def test_put_relative_export_path(self):
-        res = self.client.put("/api/settings", json={"key": "export_path", "value": "relative/path"})
-        self.assertEqual(res.status_code, 400)
-        self.assertIn("absolute", res.get_json()["error"])
+        with mock.patch("os.access", side_effect=AssertionError("should not re-check")):
+            res = self.client.put("/api/settings", json={"key": "export_path", "value": path})
+        self.assertEqual(res.status_code, 200)
 
-    def test_put_unknown_key(self):
-        res = self.client.put("/api/settings", json={"key": "unknown_key", "value": "whatever"})
-        self.assertEqual(res.status_code, 400)
-        self.assertIn("Unknown setting", res.get_json()["error"])
+    def test_failed_export_path_write_is_not_remembered(self):
+        with mock.patch.object(db, "set_setting", side_effect=sqlite3.OperationalError("disk I/O error")):
+            res = self.client.put("/api/settings", json={"key": "export_path", "value": self.tmpdir.name})
+        self.assertEqual(res.status_code, 500)
+        self.assertIsNone(app_module._last_good_export_path)
 
     def test_put_empty_value_rejected(self):
         res = self.client.put("/api/settings", json={"key": "display_unit", "value": ""})
@@ -176,24 +227,6 @@ class SettingsApiTests(unittest.TestCase):
         self.assertEqual(res.status_code, 400)
         self.assertIn("non-empty", res.get_json()["error"])
 
-    # ── Continuation Limit ──
-
-    def test_put_valid_continuation_limit(self):
-        for val in ("3", "5", "10", "all"):
-            res = self.client.put("/api/settings", json={"key": "continuation_limit", "value": val})
-            self.assertEqual(res.status_code, 200, f"Expected 200 for value '{val}'")
-            self.assertTrue(res.get_json()["ok"])
-
-    def test_put_invalid_continuation_limit_number(self):
-        res = self.client.put("/api/settings", json={"key": "continuation_limit", "value": "7"})
-        self.assertEqual(res.status_code, 400)
-        self.assertFalse(res.get_json()["ok"])
-
-    def test_put_invalid_continuation_limit_string(self):
-        res = self.client.put("/api/settings", json={"key": "continuation_limit", "value": "abc"})
-        self.assertEqual(res.status_code, 400)
-        self.assertFalse(res.get_json()["ok"])
-
     # ── Browse Dirs ──
 
     def test_browse_dirs_home(self):
@@ -235,27 +268,81 @@ class SettingsApiTests(unittest.TestCase):
         self.assertEqual(data["dirs"], ["apple", "banana", "cherry"])
 
 
+@unittest.skipUnless(app_module is not None, "flask is not installed")
+class ValidateSettingTests(unittest.TestCase):
+    """validate_setting() directly; SettingsApiTests covers the PUT route around it."""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.dir = tmpdir.name
+        self.addCleanup(setattr, app_module, "_last_good_export_path", app_module._last_good_export_path)
+        app_module._last_good_export_path = None
+
+    def assertRejected(self, key, value, message):
+        stored, error = app_module.validate_setting(key, value)
+        self.assertIsNone(stored)
+        self.assertIn(message, error)
+
+    def test_valid_display_units(self):
+        for unit in ("full", "thousands", "millions"):
+            self.assertEqual(app_module.validate_setting("display_unit", unit), (unit, None))
+
+    def test_invalid_display_unit(self):
+        self.assertRejected("display_unit", "billions", "display_unit must be one of")
+
+    def test_valid_continuation_limits(self):
+        for val in ("3", "5", "10", "all"):
+            self.assertEqual(app_module.validate_setting("continuation_limit", val), (val, None))
+
+    def test_invalid_continuation_limit(self):
+        for val in ("7", "abc"):
+            with self.subTest(val=val):
+                self.assertRejected("continuation_limit", val, "continuation_limit must be one of")
+
+    def test_export_path_must_exist(self):
+        self.assertRejected("export_path", "/nonexistent/path/xyz", "does not exist")
+
+    def test_export_path_must_be_absolute(self):
+        self.assertRejected("export_path", "relative/path", "absolute")
+
+    def test_last_saved_export_path_skips_filesystem_checks(self):
+        app_module._last_good_export_path = self.dir
+        with mock.patch("os.access", side_effect=AssertionError("should not re-check")):
+            self.assertEqual(app_module.validate_setting("export_path", self.dir), (self.dir, None))
+
+    def test_validation_does_not_record_export_path(self):
+        self.assertEqual(app_module.validate_setting("export_path", self.dir), (self.dir, None))
+        self.assertIsNone(app_module._last_good_export_path)
+
+    def test_unknown_key(self):
+        self.assertRejected("unknown_key", "whatever", "Unknown setting")
+
+
 @unittest.skipUnless(app_module is not None, "flask is not installed")
 class AmountShortFilterTests(unittest.TestCase):
     """Test that the amount_short filter respects display_unit setting."""
 
+    @classmethod
+    def setUpClass(cls):
+        config = app_module.app.config
+        cls.addClassCleanup(config.__setitem__, "TESTING", config.get("TESTING"))
+        config["TESTING"] = True
+
     def setUp(self):
         self.tmpdir = tempfile.TemporaryDirectory()
         self.addCleanup(self.tmpdir.cleanup)
         db_path = os.path.join(self.tmpdir.name, "test_filter.db")
 
-        self._orig_db_path = db.DB_PATH
-        self.addCleanup(setattr, db, "DB_PATH", self._orig_db_path)
-        db.DB_PATH = db_path
-        db.init_db()
-
-        app_module.app.config["TESTING"] = True
+        self.enterContext(override_db_path(db_path))
+        copy_template_db(db_path)
 
     def _filter_with_unit(self, unit, value):
         """Call the amount_short filter with a given display_unit."""
         conn = db.get_db()
         try:
-            db.set_setting(conn, "display_unit", unit)
+            with db.write_tx(conn):
+                db.set_setting(conn, "display_unit", unit)
         finally:
             conn.close()
 
@@ -265,21 +352,30 @@ class AmountShortFilterTests(unittest.TestCase):
             g.settings = db.get_all_settings(db.get_db())
             return app_module.amount_short_filter(value)
 
-    def test_millions_default(self):
-        result = self._filter_with_unit("millions", 80_000_000)
-        self.assertEqual(result, "80M")
-
-    def test_thousands(self):
+    def test_uses_display_unit_setting(self):
         result = self._filter_with_unit("thousands", 80_000_000)
         self.assertEqual(result, "80,000K")
 
-    def test_full(self):
-        result = self._filter_with_unit("full", 80_000_000)
-        self.assertEqual(result, "80,000,000")
-
     def test_invalid_value_passthrough(self):
-        result = self._filter_with_unit("millions", "not-a-number")
-        self.assertEqual(result, "not-a-number")
+        self.assertEqual(app_module.amount_short_filter("not-a-number"), "not-a-number")
+
+
+@unittest.skipUnless(app_module is not None, "flask is not installed")
+class FormatFilterTests(unittest.TestCase):
+    def test_amount_filter(self):
+        self.assertEqual(app_module.amount_filter(50_000_000), "50,000,000")
+        self.assertEqual(app_module.amount_filter(1234.9), "1,234")
+        self.assertEqual(app_module.amount_filter("n/a"), "n/a")
+
+    def test_rate_filter(self):
+        self.assertEqual(app_module.rate_filter(2.5), "2.5000%")
+        self.assertEqual(app_module.rate_filter(3), "3.0000%")
+        self.assertEqual(app_module.rate_filter("n/a"), "n/a")
+
+    def test_date_display_filter_accepts_strings_and_dates(self):
+        self.assertEqual(app_module.date_display_filter("2026-01-10"), "Jan 10, 2026")
+        self.assertEqual(app_module.date_display_filter(date(2026, 1, 10)), "Jan 10, 2026")
+        self.assertEqual(app_module.date_display_filter(None), "")
 
 
 if __name__ == "__main__":
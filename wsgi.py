@@ -0,0 +1,10 @@
+"""WSGI entry point for serving TenorDash with a production server.
+
+    waitress-serve --listen=127.0.0.1:5001 --threads=8 wsgi:application
+
+Run a single process with threads: the connection pool, dashboard cache and
+export worker live in process memory and are not shared between workers.
+"""
+from app import app as application, startup
+
+startup()